@@ -3,7 +3,14 @@
 # ---------------------------------------------------------------------------------
 import numpy as np
 
-def constantCorrMat(size, rho):
+def constantCorrMat(size, rho, rng=None):
+    """
+    @param size: size of the matrix
+    @param rho: correlation of every pair, in (-1 / (size - 1), 1) for a positive definite matrix
+    @param rng: unused, the matrix is deterministic; accepted like the other generators so it can be used by
+                ensemble_chunks and randCorrBlock
+    @return: numpy ndarray (size x size)
+    """
     temp_mat = np.ones((size, size)) * rho
     di = np.diag_indices(size)
     temp_mat[di] = 1.
@@ -1,22 +1,50 @@
 import numpy as np
 from numpy import linalg as LA
+import scipy.linalg
+from scipy.linalg import lapack
+import scipy.sparse
+import scipy.sparse.linalg
+
+try:
+    from sksparse.cholmod import cholesky as cholmod_cholesky, CholmodNotPositiveDefiniteError
+except ImportError:
+    cholmod_cholesky = None
+
+from .FactorCache import get_cache, cached_cholesky, cached_eigvalsh
 
 # --------------------------------------------------------------------------------
 # Diagnostics
 # --------------------------------------------------------------------------------
 
+# cause codes returned by validate_corr, bit flags in the order of PROBLEMS
+NOT_SYMMETRIC = 1
+NOT_PD = 2
+OFF_DIAGONAL = 4
+DIAGONAL = 8
+PROBLEMS = ['Not symmetric', 'Not Positive Definite', 'Off Diagonal outside [-1, 1]', 'Diagonal != 1']
+
+# maximum number of elements of the temporaries of the blocked symmetry and bounds checks
+BLOCK_ELEMENTS = 2 ** 18
+# from this size on, min_eigenvalue uses shift-invert Lanczos iterations rather than a full eigvalsh
+LANCZOS_MIN_SIZE = 500
+# numpy's batched Cholesky factorization only beats a loop over LAPACK potrf for small matrices
+BATCHED_CHOLESKY_MAX_SIZE = 32
+
+
 class CorrDiagnostics(object):
-    def __init__(self, corrmat):
-        self.symmetric = np.all(corrmat == corrmat.T)
-        self.pd = isPD(corrmat)
-        self.off_diagonal = np.all(np.abs(corrmat)<=1)
-        self.diagonal = np.all(corrmat[np.diag_indices(corrmat.shape[0])]==1)
+    def __init__(self, corrmat, tol=0.):
+        _, cause = validate_corr(corrmat, tol)
+        code = cause[0]
+        self.symmetric = not code & NOT_SYMMETRIC
+        self.pd = not code & NOT_PD
+        self.off_diagonal = not code & OFF_DIAGONAL
+        self.diagonal = not code & DIAGONAL
 
-        self.valid = self.symmetric and self.diagonal and self.off_diagonal and self.pd
+        self.valid = code == 0
 
-        self.problems = ['Not symmetric', 'Not Positive Definite', 'Off Diagonal outside [-1, 1]', 'Diagonal != 1']
+        self.problems = list(PROBLEMS)
         self.metric_vals = [self.symmetric, self.pd, self.off_diagonal, self.diagonal]
-        self._cause = [b[0] for b in zip(self.problems, self.metric_vals) if not b[1]]
+        self._cause = describe_cause(code)
 
     def __nonzero__( self) :
         return bool(self.valid)
@@ -28,17 +56,64 @@ class CorrDiagnostics(object):
     def cause(self):
         return self._cause
 
+def describe_cause(code):
+    """
+    @param code: cause code returned by validate_corr
+    @return: list of problems, e.g. ['Not symmetric', 'Off Diagonal outside [-1, 1]']
+    """
+    return [problem for bit, problem in enumerate(PROBLEMS) if int(code) & (1 << bit)]
+
 def isPD(corrmat):
     """
-    Check if all the eigenvalues of the matrix are greater than zero
+    Check if all the eigenvalues of the matrix are greater than zero, i.e. if the Cholesky factorization of its lower
+    triangle succeeds. The factorization stops at the first non-positive pivot.
 
-    @param corrmat: numpy n x n ndarray
+    @param corrmat: numpy n x n ndarray, or scipy.sparse matrix (see _sparse_pd)
     @return: bool
     """
-    lambdas = LA.eigvalsh(corrmat)
-    return all(lambdas>0)
+    if scipy.sparse.issparse(corrmat):
+        return _sparse_pd(corrmat)
+    return bool(_cholesky_pd(_as_float_stack(corrmat))[0])
+
+def min_eigenvalue(corrmat, method='auto'):
+    """
+    Smallest eigenvalue of the symmetric matrix corrmat.
 
-def isvalid_corr(corrmat):
+    @param corrmat: numpy n x n ndarray, or scipy.sparse matrix (always by Lanczos iterations from size
+                    LANCZOS_MIN_SIZE on, see _sparse_min_eigenvalue)
+    @param method: 'full' - all eigenvalues by eigvalsh
+                   'lanczos' - Lanczos iterations for the smallest eigenvalue only (scipy.sparse.linalg.eigsh), O(n^2)
+                   per iteration but slow when the bottom of the spectrum is clustered
+                   'shift-invert' - Lanczos iterations on the inverse through a Cholesky factorization, which converge
+                   in a few steps; the factorization is about a quarter of the flops of eigvalsh
+                   'auto' - 'shift-invert' for n >= LANCZOS_MIN_SIZE, 'full' otherwise
+                   The iterative methods fall back to 'full' when they fail (no convergence, matrix not PD).
+    @return: float
+    """
+    if scipy.sparse.issparse(corrmat):
+        return _sparse_min_eigenvalue(corrmat)
+    corrmat = np.asarray(corrmat, dtype=np.float64)
+    n = corrmat.shape[0]
+    if method == 'auto':
+        method = 'shift-invert' if n >= LANCZOS_MIN_SIZE else 'full'
+    if method not in ('full', 'lanczos', 'shift-invert'):
+        raise ValueError("method should be 'full', 'lanczos', 'shift-invert' or 'auto', got %s" % method)
+    try:
+        if method == 'lanczos':
+            return float(scipy.sparse.linalg.eigsh(corrmat, k=1, which='SA', return_eigenvectors=False)[0])
+        if method == 'shift-invert':
+            L, info = cached_cholesky(corrmat)
+            if info != 0:
+                raise LA.LinAlgError('not positive definite')
+            factor = (L, True)
+            inverse = scipy.sparse.linalg.LinearOperator(
+                (n, n), matvec=lambda x: scipy.linalg.cho_solve(factor, x, check_finite=False), dtype=np.float64)
+            return 1. / float(scipy.sparse.linalg.eigsh(inverse, k=1, which='LA', return_eigenvectors=False)[0])
+    except (LA.LinAlgError, scipy.sparse.linalg.ArpackNoConvergence):
+        pass
+    return float(cached_eigvalsh(corrmat)[0])
+
+def isvalid_corr(corrmat, tol=0.):
     """
     Check if
     1. corrmat is symmetric
@@ -46,25 +121,274 @@ def isvalid_corr(corrmat):
     3. diagonal values = 1
     4. the matrix is positive semidefinite.
 
-    @param corrmat: numpy nxn ndarray
+    @param corrmat: numpy nxn ndarray, or scipy.sparse matrix checked in O(nnz) memory (see validate_corr)
+    @param tol: absolute tolerance of the checks 1-3 (exact by default)
     @return: CorrDiagnostics object ---> evaluates to True if corrmat is valid and False otherwise, .cause gives the cause
     """
-    return CorrDiagnostics(corrmat)
+    return CorrDiagnostics(corrmat, tol)
+
+def validate_corr(corrmats, tol=0.):
+    """
+    Vectorized isvalid_corr for a single matrix or a stack of them.
+
+    Symmetry and bounds are checked in blocks of rows, so the temporaries never exceed BLOCK_ELEMENTS elements, and
+    positive definiteness with a Cholesky factorization which stops at the first non-positive pivot. With the
+    factorization cache on (see FactorCache.enable_cache), the Cholesky factor of a single matrix is looked up and
+    stored there, a stack is always factorized in batches.
+
+    A scipy.sparse matrix is checked without densifying it, positive definiteness by _sparse_pd.
+
+    @param corrmats: numpy ndarray (n x n) or (batch x n x n), or a scipy.sparse matrix
+    @param tol: absolute tolerance of the symmetry, diagonal and bounds checks (exact by default)
+    @return: (valid, cause) - numpy bool array (batch,) and numpy int array (batch,) of cause codes, a combination
+             of the bit flags NOT_SYMMETRIC, NOT_PD, OFF_DIAGONAL and DIAGONAL (see describe_cause)
+    """
+    if scipy.sparse.issparse(corrmats):
+        return _validate_sparse(corrmats, tol)
+    C = _as_float_stack(corrmats)
+    batch, n = C.shape[0], C.shape[1]
+    cause = np.zeros(batch, dtype=np.int64)
+
+    diag = np.diagonal(C, axis1=1, axis2=2)
+    cause[~np.all(np.abs(diag - 1) <= tol, axis=1)] |= DIAGONAL
+
+    symmetric = np.ones(batch, dtype=bool)
+    bounded = np.ones(batch, dtype=bool)
+    rows = min(n, max(1, BLOCK_ELEMENTS // max(1, n)))
+    mats = max(1, BLOCK_ELEMENTS // max(1, rows * n))
+    for b0 in range(0, batch, mats):
+        b1 = min(batch, b0 + mats)
+        for i0 in range(0, n, rows):
+            i1 = min(n, i0 + rows)
+            # rows i0:i1 against columns i0:i1, only from column i0 on as the lower part was compared already
+            upper = C[b0:b1, i0:i1, i0:]
+            lower = C[b0:b1, i0:, i0:i1].transpose(0, 2, 1)
+            symmetric[b0:b1] &= np.all(np.abs(upper - lower) <= tol, axis=(1, 2))
+            bounded[b0:b1] &= np.all(np.abs(C[b0:b1, i0:i1, :]) <= 1 + tol, axis=(1, 2))
+    cause[~symmetric] |= NOT_SYMMETRIC
+    cause[~bounded] |= OFF_DIAGONAL
+    cause[~_cholesky_pd(C)] |= NOT_PD
+    return cause == 0, cause
+
+def _validate_sparse(C, tol):
+    C = scipy.sparse.csr_matrix(C, dtype=np.float64)
+    code = 0
+    if not np.all(np.abs(C.diagonal() - 1) <= tol):
+        code |= DIAGONAL
+    asymmetry = abs(C - C.T)
+    if asymmetry.nnz and asymmetry.max() > tol:
+        code |= NOT_SYMMETRIC
+    if C.nnz and np.abs(C.data).max() > 1 + tol:
+        code |= OFF_DIAGONAL
+    if not _sparse_pd(C):
+        code |= NOT_PD
+    return np.array([code == 0]), np.array([code], dtype=np.int64)
+
+def _sparse_pd(C):
+    """
+    Positive definiteness of the sparse symmetric matrix C, by the cheapest conclusive test of
+    1. Gershgorin: strict diagonal dominance C_ii > sum_j!=i |C_ij| certifies C in O(nnz)
+    2. a sparse Cholesky factorization (CHOLMOD), when scikit-sparse is installed
+    3. the smallest eigenvalue by Lanczos iterations, see _sparse_min_eigenvalue
+    """
+    C = scipy.sparse.csr_matrix(C, dtype=np.float64)
+    diag = C.diagonal()
+    off_diagonal = np.asarray(abs(C).sum(axis=1)).ravel() - np.abs(diag)
+    if np.all(diag - off_diagonal > 0):
+        return True
+    if cholmod_cholesky is not None:
+        try:
+            cholmod_cholesky(C.tocsc())
+            return True
+        except CholmodNotPositiveDefiniteError:
+            return False
+    return _sparse_min_eigenvalue(C) > 0
+
+def _sparse_min_eigenvalue(C):
+    """
+    Smallest eigenvalue of the sparse symmetric matrix C: dense below LANCZOS_MIN_SIZE, otherwise by Lanczos
+    iterations on C itself (products in O(nnz)), then shift-invert iterations around a Gershgorin lower bound of the
+    spectrum (a sparse LU factorization) if they do not converge.
+    """
+    C = scipy.sparse.csr_matrix(C, dtype=np.float64)
+    n = C.shape[0]
+    if n < LANCZOS_MIN_SIZE:
+        return float(LA.eigvalsh(C.toarray())[0])
+    try:
+        return float(scipy.sparse.linalg.eigsh(C, k=1, which='SA', return_eigenvectors=False)[0])
+    except scipy.sparse.linalg.ArpackNoConvergence:
+        pass
+    diag = C.diagonal()
+    # every eigenvalue is above sigma, so the one nearest to it is the smallest
+    sigma = float(np.min(2 * diag - np.asarray(abs(C).sum(axis=1)).ravel())) - 1e-3
+    mu = scipy.sparse.linalg.eigsh(C, k=1, sigma=sigma, which='LM', return_eigenvectors=False)[0]
+    return float(mu)
+
+def _as_float_stack(corrmats):
+    C = np.asarray(corrmats)
+    if not np.issubdtype(C.dtype, np.floating):
+        C = C.astype(np.float64)
+    return C[None] if C.ndim == 2 else C
+
+def _cholesky_pd(C):
+    """
+    Positive definiteness of each matrix of the stack C from the Cholesky factorization of its lower triangle, by
+    LAPACK potrf which stops at the first non-positive pivot. Small matrices are first factorized in batched chunks,
+    and only a chunk holding a non-PD matrix goes through potrf matrix by matrix. The factorization cache is only
+    consulted for a single matrix: a stack would flood it with factors that are never looked up again.
+    """
+    if C.shape[0] == 1 and get_cache() is not None:
+        return np.array([cached_cholesky(C[0])[1] == 0])
+    pd = np.ones(C.shape[0], dtype=bool)
+    n = C.shape[1]
+    potrf, = lapack.get_lapack_funcs(('potrf',), (C,))
+    mats = max(1, BLOCK_ELEMENTS // max(1, n * n)) if n <= BATCHED_CHOLESKY_MAX_SIZE else 1
+    for b0 in range(0, C.shape[0], mats):
+        chunk = C[b0:b0 + mats]
+        if mats > 1:
+            try:
+                LA.cholesky(chunk)
+                continue
+            except LA.LinAlgError:
+                pass
+        pd[b0:b0 + mats] = [potrf(c, lower=1, clean=0)[1] == 0 for c in chunk]
+    return pd
+
+class OffDiagonalStats(object):
+    """
+    Streaming statistics of the off-diagonal entries (upper triangle) of an ensemble of correlation matrices: fixed
+    bin histogram counts, mean, variance, min and max, and the number of invalid matrices.
+
+    Matrices or (batch x n x n) stacks are added one at a time with update, so the memory used is O(bins) however
+    large the ensemble. Accumulators built in different processes are combined with merge.
+
+    Example:
+        stats = OffDiagonalStats(bins=100)
+        for chunk in ensemble_chunks('randCorrOnion', 10**6, size=50):
+            stats.update(chunk)
+        stats.mean, stats.variance, stats.counts
+    """
+    def __init__(self, bins=50, range=(-1., 1.)):
+        self.edges = np.linspace(range[0], range[1], bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.num_nan = 0
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.num_matrices = 0
+        self.num_invalid = 0
+        self._triu = {}
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def update(self, corrmats, validate=False):
+        """
+        @param corrmats: numpy ndarray (n x n) or (batch x n x n)
+        @param validate: also count the matrices failing validate_corr
+        @return: cause codes of validate_corr if validate, else None
+        """
+        C = np.asarray(corrmats)
+        C = C[None] if C.ndim == 2 else C
+        n = C.shape[1]
+        if n not in self._triu:
+            self._triu[n] = np.triu_indices(n, 1)
+        rows, cols = self._triu[n]
+        self._add(C[:, rows, cols].ravel())
+        self.num_matrices += C.shape[0]
+
+        if validate:
+            valid, cause = validate_corr(C)
+            self.num_invalid += int(np.sum(~valid))
+            return cause
+
+    def _add(self, x):
+        nan = np.isnan(x)
+        if nan.any():
+            self.num_nan += int(np.sum(nan))
+            x = x[~nan]
+        if x.size == 0:
+            return
+
+        lo, hi = self.edges[0], self.edges[-1]
+        bins = len(self.counts)
+        below, above = x < lo, x > hi
+        self.underflow += int(np.sum(below))
+        self.overflow += int(np.sum(above))
+        idx = ((x[~(below | above)] - lo) * (bins / (hi - lo))).astype(np.int64)
+        np.minimum(idx, bins - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=bins)
+
+        self._merge_moments(x.size, np.mean(x), np.sum((x - np.mean(x)) ** 2), np.min(x), np.max(x))
+
+    def _merge_moments(self, count, mean, m2, xmin, xmax):
+        # Chan et al. pairwise update of the mean and the sum of squared deviations
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, xmin)
+        self.max = max(self.max, xmax)
 
-def plot_histogram_off_diagonal(list_of_rand_corr_mat, print_cause=True):
-    if 'plt' not in globals():
-        import matplotlib.pyplot as plt
-    else:
-        plt = globals()['plt']
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator (e.g. from a worker process) with the same bins.
 
-    results = []
-    nt_valid = 0
+        @param other: OffDiagonalStats
+        @return: self
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge OffDiagonalStats with different bins')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.num_nan += other.num_nan
+        if other.count:
+            self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        self.num_matrices += other.num_matrices
+        self.num_invalid += other.num_invalid
+        return self
+
+    def plot(self, ax=None):
+        """
+        Bar plot of the histogram (requires matplotlib).
+
+        @param ax: matplotlib axes, the current axes by default
+        @return: the matplotlib axes
+        """
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
+        ax.bar(self.edges[:-1], self.counts, width=np.diff(self.edges), align='edge')
+        return ax
+
+def plot_histogram_off_diagonal(list_of_rand_corr_mat, print_cause=True, bins=50, plot=True):
+    """
+    Histogram of the off-diagonal values of an ensemble of correlation matrices, counting the invalid ones.
+
+    @param list_of_rand_corr_mat: iterable of matrices or (batch x n x n) stacks, e.g. ensemble_chunks(...)
+    @param print_cause: print the cause of every invalid matrix
+    @param bins: number of bins of the histogram over [-1, 1]
+    @param plot: plot the histogram with matplotlib
+    @return: OffDiagonalStats
+    """
+    stats = OffDiagonalStats(bins)
     for c in list_of_rand_corr_mat:
-        res = isvalid_corr(c)
-        if not res:
-            nt_valid += 1
-            if print_cause:
-                print(res.cause)
-        results.extend(list(c.ravel()))
-    plt.hist(results)
-    print('%s matrices are not valid' % nt_valid)
\ No newline at end of file
+        cause = stats.update(c, validate=True)
+        if print_cause:
+            for code in cause[cause != 0]:
+                print(describe_cause(code))
+    if plot:
+        stats.plot()
+    print('%s matrices are not valid' % stats.num_invalid)
+    return stats
@@ -0,0 +1,105 @@
+# ---------------------------------------------------------------------------------
+# Streaming ensembles of random correlation matrices
+# ---------------------------------------------------------------------------------
+import numpy as np
+
+from .RandomCorr import randCorr, randCorrFactor, randCorrLKJ, randCorrOnion
+from .RandomCorrMatEigen import randCorrGivenEgienvalues
+from .ConstantCorr import constantCorrMat
+from .Parallel import bounded_imap, plan_execution
+from .RandomStreams import as_seed_seq, child_seed
+
+GENERATORS = {'randCorr': randCorr,
+              'randCorrOnion': randCorrOnion,
+              'randCorrFactor': randCorrFactor,
+              'randCorrLKJ': randCorrLKJ,
+              'randCorrGivenEgienvalues': randCorrGivenEgienvalues,
+              'constantCorrMat': constantCorrMat}
+
+# generators which draw a whole (batch x n x n) stack in one call
+BATCHED_GENERATORS = {'randCorr', 'randCorrOnion', 'randCorrFactor', 'randCorrLKJ'}
+
+
+def generator_name(generator):
+    """
+    @param generator: name of a generator in GENERATORS or the function itself
+    @return: name of the generator
+    """
+    if generator in GENERATORS:
+        return generator
+    for name, func in GENERATORS.items():
+        if func is generator:
+            return name
+    raise ValueError('Unknown generator %s, expected one of %s' % (generator, sorted(GENERATORS)))
+
+
+def chunk_seed(seed_seq, chunk_id):
+    """
+    Independent seed stream of the chunk_id-th chunk: a child of seed_seq which only depends on the chunk index, so
+    the ensemble is the same whatever the number of workers.
+
+    @param seed_seq: numpy.random.SeedSequence of the ensemble
+    @param chunk_id: index of the chunk
+    @return: numpy.random.SeedSequence
+    """
+    return child_seed(seed_seq, chunk_id)
+
+
+def generate_chunk(generator, count, seed, kwargs):
+    """
+    Draw count matrices from generator with a PCG64 generator seeded from seed, passed as its rng argument (the
+    global numpy random state is left alone).
+
+    @param generator: name of the generator
+    @param count: number of matrices
+    @param seed: numpy.random.SeedSequence
+    @param kwargs: keyword arguments of the generator
+    @return: numpy ndarray (count x n x n)
+    """
+    func = GENERATORS[generator]
+    rng = np.random.Generator(np.random.PCG64(seed))
+    if generator in BATCHED_GENERATORS:
+        return func(batch=count, rng=rng, **kwargs)
+    return np.stack([func(rng=rng, **kwargs) for _ in range(count)])
+
+
+def ensemble_chunks(generator, num_matrices, chunk_size=1000, n_jobs=1, seed=None, max_in_flight=None, start_chunk=0,
+                    **kwargs):
+    """
+    Stream an ensemble of num_matrices random correlation matrices as (chunk_size x n x n) stacks (the last one may
+    be smaller), generated over a pool of n_jobs processes.
+
+    Every chunk has its own seed stream derived from seed and the chunk index, so the ensemble is reproducible and
+    does not depend on n_jobs. At most max_in_flight chunks are pending at any time, memory is therefore bounded by
+    max_in_flight * chunk_size matrices however large num_matrices is.
+
+    Example:
+        for chunk in ensemble_chunks('randCorrOnion', 10**7, chunk_size=10**4, n_jobs=-1, seed=42, size=100):
+            ...
+
+    @param generator: 'randCorr', 'randCorrOnion', 'randCorrLKJ', 'randCorrFactor', 'randCorrGivenEgienvalues' or the
+                      function
+    @param num_matrices: total number of matrices
+    @param chunk_size: number of matrices per chunk, at least 1
+    @param n_jobs: number of worker processes, None or 1 runs serially, -1 uses all cpus, 'auto' chooses between
+                   worker processes and BLAS threads from the size and the number of chunks (see Parallel.ThreadBudget)
+    @param seed: int, sequence of ints, numpy.random.SeedSequence or Generator, None draws fresh entropy
+    @param max_in_flight: maximum number of pending chunks (default 2 * n_jobs)
+    @param start_chunk: index of the first chunk to generate, to resume an interrupted run (see EnsembleStore)
+    @param kwargs: arguments of the generator, e.g. size=100 or lamb=eigenvalues
+    @return: generator of numpy ndarrays (chunk_size x n x n)
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size should be at least 1, got %s' % chunk_size)
+    name = generator_name(generator)
+    seed_seq = np.random.SeedSequence() if seed is None else as_seed_seq(seed)
+    num_chunks = -(-num_matrices // chunk_size)
+
+    def tasks():
+        for chunk_id in range(start_chunk, num_chunks):
+            count = min(chunk_size, num_matrices - chunk_id * chunk_size)
+            yield name, count, chunk_seed(seed_seq, chunk_id), kwargs
+
+    size = kwargs['size'] if 'size' in kwargs else len(np.ravel(kwargs.get('lamb', ())))
+    n_jobs, blas_threads = plan_execution(size, num_chunks - start_chunk, n_jobs, batch=chunk_size)
+    return bounded_imap(generate_chunk, tasks(), n_jobs=n_jobs, max_in_flight=max_in_flight, blas_threads=blas_threads)
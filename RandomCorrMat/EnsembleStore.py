@@ -0,0 +1,220 @@
+# ---------------------------------------------------------------------------------
+# On-disk ensembles of correlation matrices as packed upper triangles
+# ---------------------------------------------------------------------------------
+import json
+import os
+
+import numpy as np
+
+from .Ensemble import ensemble_chunks, generator_name, chunk_seed
+from .RandomStreams import as_seed_seq
+
+FORMAT_VERSION = 2
+
+
+def packed_size(n):
+    """
+    @param n: size of the matrices
+    @return: number of stored values per matrix, n(n-1)/2
+    """
+    return n * (n - 1) // 2
+
+def matrix_size(m):
+    """
+    Inverse of packed_size.
+
+    @param m: number of stored values per matrix
+    @return: size n of the matrices
+    """
+    n = int(round((1 + np.sqrt(1 + 8 * m)) / 2))
+    if packed_size(n) != m:
+        raise ValueError('%d is not the size of a packed upper triangle' % m)
+    return n
+
+def pack(corrmats, dtype=None):
+    """
+    Strict upper triangles of correlation matrices, row by row (the unit diagonal is not stored).
+
+    @param corrmats: numpy ndarray (n x n) or (batch x n x n)
+    @param dtype: dtype of the result (default that of corrmats)
+    @return: numpy ndarray (n(n-1)/2,) or (batch x n(n-1)/2)
+    """
+    corrmats = np.asarray(corrmats)
+    iu = np.triu_indices(corrmats.shape[-1], 1)
+    return corrmats[..., iu[0], iu[1]].astype(dtype or corrmats.dtype, copy=False)
+
+def unpack(packed, dtype=np.float64):
+    """
+    Full symmetric matrices with unit diagonal from their packed upper triangles.
+
+    @param packed: numpy ndarray (n(n-1)/2,) or (batch x n(n-1)/2)
+    @param dtype: dtype of the result
+    @return: numpy ndarray (n x n) or (batch x n x n)
+    """
+    packed = np.asarray(packed)
+    n = matrix_size(packed.shape[-1])
+    out = np.empty(packed.shape[:-1] + (n, n), dtype=dtype)
+    iu = np.triu_indices(n, 1)
+    out[..., iu[0], iu[1]] = packed
+    out[..., iu[1], iu[0]] = packed
+    out[..., np.arange(n), np.arange(n)] = 1.
+    return out
+
+
+class EnsembleStore(object):
+    """
+    Read access to an ensemble written by write_ensemble: a .npy file of packed upper triangles (one row of
+    n(n-1)/2 values per matrix) opened as a read-only memory map, and a JSON sidecar path + '.json' with the
+    generator, its parameters and the seed of every chunk.
+
+    Nothing is read from disk until it is used. store.packed[i] or store.packed[i:j] are views of the memory map,
+    store[i] and store[i:j] unpack full matrices on demand. Only the matrices of completed chunks are visible, so an
+    interrupted run can be read up to where it stopped.
+
+    Example:
+        store = write_ensemble('onion.npy', 'randCorrOnion', 10**6, chunk_size=10**4, seed=42, size=50)
+        for i in range(0, len(store), 1000):
+            stats.update(store[i:i + 1000])
+
+    @param path: path of the .npy file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_metadata(path)
+        self.n = self.meta['size']
+        self._data = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['num_written']
+
+    def __repr__(self):
+        return 'EnsembleStore(%r, generator=%s, size=%d, matrices=%d/%d, dtype=%s)' % (
+            self.path, self.meta['generator'], self.n, len(self), self.meta['num_matrices'], self.meta['dtype'])
+
+    @property
+    def complete(self):
+        return len(self) == self.meta['num_matrices']
+
+    @property
+    def packed(self):
+        """
+        Memory mapped (matrices x n(n-1)/2) array of the completed chunks, indexing it does not copy.
+        """
+        return self._data[:len(self)]
+
+    def __getitem__(self, index):
+        """
+        @param index: int or slice
+        @return: numpy ndarray (n x n) or (batch x n x n), float64
+        """
+        return unpack(self.packed[index])
+
+    def chunks(self, chunk_size=None):
+        """
+        @param chunk_size: number of matrices per stack (default the chunk size of the run)
+        @return: generator of unpacked numpy ndarrays (chunk_size x n x n)
+        """
+        chunk_size = chunk_size or self.meta['chunk_size']
+        for start in range(0, len(self), chunk_size):
+            yield self[start:start + chunk_size]
+
+
+def write_ensemble(path, generator, num_matrices, chunk_size=1000, n_jobs=1, seed=None, dtype=np.float64,
+                   max_in_flight=None, **kwargs):
+    """
+    Generate an ensemble with ensemble_chunks and store it in path as packed upper triangles, e.g. float32 halves
+    the disk size again (a nearly singular matrix may then round to an indefinite one).
+
+    The sidecar path + '.json' is rewritten atomically after each chunk is flushed. When path already holds an
+    unfinished run of the same generator, parameters and seed, the generation resumes after its last completed
+    chunk; every chunk has its own seed stream, so the result is the same as an uninterrupted run.
+
+    @param path: path of the .npy file
+    @param generator: 'randCorr', 'randCorrOnion', 'randCorrLKJ', 'randCorrFactor', 'randCorrGivenEgienvalues' or the
+                      function
+    @param num_matrices: total number of matrices, at least 1
+    @param chunk_size: number of matrices per chunk
+    @param n_jobs: number of worker processes or 'auto' (see ensemble_chunks)
+    @param seed: int, sequence of ints, numpy.random.SeedSequence or Generator, None draws fresh entropy (recorded in the
+                 sidecar) or reuses that of the run to resume
+    @param dtype: numpy.float64 or numpy.float32
+    @param max_in_flight: maximum number of pending chunks (see ensemble_chunks)
+    @param kwargs: arguments of the generator
+    @return: EnsembleStore
+    """
+    if num_matrices < 1:
+        raise ValueError('num_matrices should be at least 1, got %s' % num_matrices)
+    name = generator_name(generator)
+    params = _jsonable(kwargs)
+    dtype = np.dtype(dtype).str
+    meta = read_metadata(path) if os.path.exists(_sidecar(path)) else None
+    if meta is not None:
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError('%s was written with format version %s, it cannot be resumed by version %d, remove it '
+                             'to start a new run' % (path, meta.get('version'), FORMAT_VERSION))
+        run = (meta['generator'], meta['params'], meta['num_matrices'], meta['chunk_size'], meta['dtype'])
+        if run != (name, params, num_matrices, chunk_size, dtype):
+            raise ValueError('%s holds a different ensemble (generator %s, params %s), remove it to start a new run'
+                             % (path, meta['generator'], meta['params']))
+        recorded = np.random.SeedSequence(meta['seed']['entropy'], spawn_key=tuple(meta['seed']['spawn_key']))
+        if seed is not None and _seed_record(_as_seed_seq(seed)) != meta['seed']:
+            raise ValueError('%s was generated with another seed, remove it to start a new run' % path)
+        seed_seq = recorded
+    else:
+        seed_seq = _as_seed_seq(seed)
+        meta = {'version': FORMAT_VERSION, 'generator': name, 'params': params, 'num_matrices': num_matrices,
+                'chunk_size': chunk_size, 'dtype': dtype, 'seed': _seed_record(seed_seq), 'size': None,
+                'num_written': 0, 'chunks': []}
+
+    start_chunk = len(meta['chunks'])
+    data = np.load(path, mmap_mode='r+') if start_chunk else None
+    for chunk_id, chunk in enumerate(ensemble_chunks(name, num_matrices, chunk_size=chunk_size, n_jobs=n_jobs,
+                                                     seed=seed_seq, max_in_flight=max_in_flight,
+                                                     start_chunk=start_chunk, **kwargs), start_chunk):
+        if data is None:
+            meta['size'] = chunk.shape[-1]
+            data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                             shape=(num_matrices, packed_size(meta['size'])))
+        start = chunk_id * chunk_size
+        data[start:start + len(chunk)] = pack(chunk, dtype)
+        data.flush()
+        meta['chunks'].append({'chunk': chunk_id, 'start': start, 'count': len(chunk),
+                               'seed': _seed_record(chunk_seed(seed_seq, chunk_id))})
+        meta['num_written'] = start + len(chunk)
+        _write_json(_sidecar(path), meta)
+    del data
+    return EnsembleStore(path)
+
+def read_metadata(path):
+    """
+    @param path: path of the .npy file of an ensemble
+    @return: dict of the JSON sidecar
+    """
+    with open(_sidecar(path)) as f:
+        return json.load(f)
+
+
+def _sidecar(path):
+    return path + '.json'
+
+def _write_json(path, obj):
+    # write then rename, so an interruption leaves either the previous or the new sidecar
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _as_seed_seq(seed):
+    return np.random.SeedSequence() if seed is None else as_seed_seq(seed)
+
+def _seed_record(seed_seq):
+    entropy = seed_seq.entropy
+    if not isinstance(entropy, int):
+        entropy = [int(e) for e in entropy]
+    return {'entropy': entropy, 'spawn_key': [int(k) for k in seed_seq.spawn_key]}
+
+def _jsonable(obj):
+    # parameters as they read back from the sidecar, to compare them with those of a resumed run
+    return json.loads(json.dumps(obj, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)))
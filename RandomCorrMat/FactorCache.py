@@ -0,0 +1,191 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from numpy import linalg as LA
+from scipy.linalg import lapack
+
+# --------------------------------------------------------------------------------
+# Cache of matrix factorizations
+# --------------------------------------------------------------------------------
+
+# default memory bound of enable_cache
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+_cache = None
+
+
+class FactorCache(object):
+    """
+    Memory bounded LRU cache of eigendecompositions and Cholesky factors of symmetric matrices.
+
+    Entries are keyed by a hash (blake2b) of the matrix bytes together with its shape and dtype, so equal matrices
+    share their factorizations whatever array holds them. Hashing reads the n^2 entries once, far cheaper than any
+    O(n^3) factorization. When the stored arrays exceed max_bytes, the least recently used entries are evicted.
+
+    The returned arrays are the cached ones, made read-only.
+
+    Example:
+        cache = enable_cache(max_bytes=2 ** 30)
+        isPD(C); perturb_randCorr(C, num=100); nearcorr(C)
+        cache.hits, cache.misses, cache.evictions
+
+    @param max_bytes: bound on the memory held by the cached arrays
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'FactorCache(entries=%d, nbytes=%d, max_bytes=%d, hits=%d, misses=%d, evictions=%d)' % (
+            len(self), self.nbytes, self.max_bytes, self.hits, self.misses, self.evictions)
+
+    @staticmethod
+    def key(A):
+        """
+        @param A: numpy ndarray
+        @return: hashable key of the contents, shape and dtype of A
+        """
+        A = np.ascontiguousarray(A)
+        digest = hashlib.blake2b(A.view(np.uint8).reshape(-1), digest_size=16).digest()
+        return digest, A.shape, A.dtype.str
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def eigh(self, A):
+        """
+        @param A: symmetric numpy array (n x n)
+        @return: (eigenvalues, eigenvectors) as returned by numpy.linalg.eigh
+        """
+        key = self.key(A)
+        res = self._get(('eigh', key))
+        if res is None:
+            res = self._put(('eigh', key), LA.eigh(A))
+        return res
+
+    def eigvalsh(self, A):
+        """
+        Eigenvalues in ascending order, taken from a cached eigendecomposition when there is one.
+
+        @param A: symmetric numpy array (n x n)
+        @return: numpy array (n,)
+        """
+        key = self.key(A)
+        res = self._get(('eigh', key), count_miss=False)
+        if res is not None:
+            return res[0]
+        res = self._get(('eigvalsh', key))
+        if res is None:
+            res = self._put(('eigvalsh', key), (LA.eigvalsh(A),))
+        return res[0]
+
+    def cholesky(self, A):
+        """
+        Cholesky factorization of the lower triangle of A by LAPACK potrf.
+
+        @param A: symmetric numpy array (n x n)
+        @return: (L, info) - lower triangular factor and potrf info, info > 0 when A is not positive definite (L is
+                 then only partially factorized)
+        """
+        key = self.key(A)
+        res = self._get(('cholesky', key))
+        if res is None:
+            res = self._put(('cholesky', key), _cholesky(A))
+        return res
+
+    def _get(self, key, count_miss=True):
+        with self._lock:
+            res = self._entries.get(key)
+            if res is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            elif count_miss:
+                self.misses += 1
+        return None if res is None else res[0]
+
+    def _put(self, key, arrays):
+        arrays = tuple(_readonly(a) for a in arrays)
+        size = sum(a.nbytes for a in arrays if isinstance(a, np.ndarray))
+        if size > self.max_bytes:
+            return arrays
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (arrays, size)
+                self.nbytes += size
+            self._evict()
+        return arrays
+
+    def _evict(self):
+        # least recently used first, with the lock held
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+
+def _readonly(a):
+    if isinstance(a, np.ndarray):
+        a.setflags(write=False)
+    return a
+
+def _cholesky(A):
+    potrf, = lapack.get_lapack_funcs(('potrf',), (A,))
+    L, info = potrf(A, lower=1, clean=1)
+    return L, int(info)
+
+
+# --------------------------------------------------------------------------------
+# Process wide cache, consulted by Diagnostics, RandomPerturb and RandomCorrNear
+# --------------------------------------------------------------------------------
+
+def enable_cache(max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Turn on the process wide factorization cache (or resize it when already on).
+
+    @param max_bytes: bound on the memory held by the cached arrays
+    @return: the FactorCache
+    """
+    global _cache
+    if _cache is None:
+        _cache = FactorCache(max_bytes)
+    else:
+        with _cache._lock:
+            _cache.max_bytes = max_bytes
+            _cache._evict()
+    return _cache
+
+def disable_cache():
+    """
+    Turn off the process wide factorization cache and release its memory.
+    """
+    global _cache
+    if _cache is not None:
+        _cache.clear()
+    _cache = None
+
+def get_cache():
+    """
+    @return: the process wide FactorCache, None when disabled
+    """
+    return _cache
+
+def cached_eigh(A):
+    return LA.eigh(A) if _cache is None else _cache.eigh(A)
+
+def cached_eigvalsh(A):
+    return LA.eigvalsh(A) if _cache is None else _cache.eigvalsh(A)
+
+def cached_cholesky(A):
+    return _cholesky(A) if _cache is None else _cache.cholesky(A)
@@ -0,0 +1,184 @@
+# ---------------------------------------------------------------------------------
+# Online correlation estimates from streamed observations, repaired only when invalid
+# ---------------------------------------------------------------------------------
+import numpy as np
+import scipy.linalg
+import scipy.sparse.linalg
+from scipy.linalg import blas
+
+from .Diagnostics import LANCZOS_MIN_SIZE
+from .RandomCorrNear import nearcorr
+
+
+class OnlineCorrEstimator(object):
+    """
+    Sample correlation matrix of a stream of observations (e.g. returns tick by tick), valid at any moment.
+
+    The second moment M is updated in O(n^2) per observation by a rank-one update of its upper triangle: the scatter
+    matrix S += (k-1)/k d d' (Welford) for the plain estimate, or the covariance M = w (M + (1-w) d d') with the
+    decay w = 2^(-1/halflife) for the exponentially weighted one, d being the deviation from the running mean.
+
+    The smallest eigenvalue of the correlation C = D^-1/2 M D^-1/2, D = diag(M), is tracked without any
+    eigendecomposition: the rank-one term is positive semidefinite, so lambda_min(M) decreases at most by the factor
+    w (Weyl), and lambda_min(C) >= lambda_min(M) / max(D). Variables without variance are left out of the bound
+    (their rows of C are unit vectors, of eigenvalue 1), the bound being that of the block of the others. Only when this bound no longer certifies C is its smallest
+    eigenpair recomputed, by Lanczos iterations started from the previous eigenvector (a dense eigensolver below
+    LANCZOS_MIN_SIZE), and only when C is then found invalid is it repaired by nearcorr, warm started from the
+    previous repair, then shrunk towards the identity just enough for its smallest eigenvalue to reach tol (the
+    nearest correlation matrix is only semidefinite). The result is cached until the next update.
+
+    Example:
+        est = OnlineCorrEstimator(500, halflife=250)
+        for x in ticks:
+            est.update(x)
+            C = est.correlation()
+
+    @param n: number of variables
+    @param halflife: number of observations after which their weight halves, None for equal weights
+    @param tol: C is considered valid when its smallest eigenvalue is above tol, the repaired matrices have their
+                smallest eigenvalue at tol
+    @param kwargs: arguments of the nearcorr repair, method='newton' by default, e.g. max_iterations
+    """
+    def __init__(self, n, halflife=None, tol=1e-10, **kwargs):
+        self.n = n
+        self.halflife = halflife
+        self.decay = None if halflife is None else 0.5 ** (1. / halflife)
+        self.tol = tol
+        self.nearcorr_kwargs = dict({'method': 'newton'}, **kwargs)
+        self.count = 0
+        self.mean = np.zeros(n)
+        # upper triangle of the scatter matrix (equal weights) or of the covariance (exponential weights)
+        self._moment = np.zeros((n, n), order='F')
+        # lower bound of the smallest eigenvalue of the moment matrix restricted to the variables of _support
+        self._moment_bound = 0.
+        self._support = None
+        self._eigvec = None
+        self._cached = None
+        self._repair = None
+        self.min_eigenvalue = None
+        self.num_eigen_refreshes = 0
+        self.num_repairs = 0
+
+    def __repr__(self):
+        return 'OnlineCorrEstimator(n=%d, halflife=%s, count=%d, eigen_refreshes=%d, repairs=%d)' % (
+            self.n, self.halflife, self.count, self.num_eigen_refreshes, self.num_repairs)
+
+    def update(self, x):
+        """
+        Add observations, O(n^2) each.
+
+        @param x: numpy array (n,) or (m x n), one observation per row
+        @return: self
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[-1] != self.n:
+            raise ValueError('expected observations of %d variables, got shape %s' % (self.n, x.shape))
+        rows = x.reshape(-1, self.n)
+        if self.decay is None and len(rows) > 1:
+            self._update_block(rows)
+        else:
+            for row in rows:
+                self._update_one(row)
+        self._cached = None
+        return self
+
+    def _update_one(self, x):
+        self.count += 1
+        d = x - self.mean
+        if self.decay is None:
+            self.mean += d / self.count
+            blas.dsyr((self.count - 1.) / self.count, d, a=self._moment, overwrite_a=1)
+        elif self.count == 1:
+            self.mean[:] = x
+        else:
+            w = self.decay
+            self.mean += (1 - w) * d
+            self._moment *= w
+            blas.dsyr(w * (1 - w), d, a=self._moment, overwrite_a=1)
+            self._moment_bound *= w
+
+    def _update_block(self, X):
+        # Chan et al. pairwise combination of the scatter matrices, one matrix product for the whole block
+        m = len(X)
+        total = self.count + m
+        mean = X.mean(axis=0)
+        Xc = X - mean
+        d = mean - self.mean
+        self._moment += np.dot(Xc.T, Xc) + (self.count * m / float(total)) * np.outer(d, d)
+        self.mean += d * (m / float(total))
+        self.count = total
+
+    def covariance(self):
+        """
+        @return: the covariance matrix (n x n), O(n^2)
+        """
+        M = self._full_moment()
+        if self.decay is None:
+            M /= max(self.count - 1, 1)
+        return M
+
+    def _full_moment(self):
+        M = np.triu(self._moment)
+        return M + np.triu(M, 1).T
+
+    def correlation(self, repair=True):
+        """
+        The current correlation matrix, repaired by nearcorr if it is not valid (e.g. fewer observations than
+        variables). Variables without variance have no correlation with the others.
+
+        @param repair: if False return the sample correlation as it is
+        @return: numpy array (n x n)
+        """
+        if self.count < 2:
+            raise ValueError('at least 2 observations are needed, got %d' % self.count)
+        if self._cached is not None and repair:
+            return self._cached.copy()
+        M = self._full_moment()
+        D = np.diag(M).copy()
+        std = np.sqrt(D)
+        std[std == 0] = 1.
+        C = M / np.outer(std, std)
+        C[np.diag_indices(self.n)] = 1.
+        if not repair:
+            return C
+
+        support = D > 0
+        if not np.array_equal(support, self._support):
+            # a variable gained variance, the bound does not cover it
+            self._support = support
+            self._moment_bound = 0.
+        bound = self._moment_bound / D.max() if support.any() else 1.
+        if bound <= self.tol:
+            lamb = self._refresh(C)
+            self._moment_bound = lamb * D[support].min() if support.any() else 0.
+            bound = lamb
+        self.min_eigenvalue = bound
+        if bound <= self.tol:
+            self._repair = nearcorr(C, warm_start=self._repair, full_output=True, **self.nearcorr_kwargs)
+            self.num_repairs += 1
+            C = self._repair.X
+            lamb = self._refresh(C)
+            if lamb < self.tol:
+                # (1 - a) C + a I has the smallest eigenvalue (1 - a) lamb + a and a unit diagonal
+                a = (self.tol - lamb) / (1 - lamb)
+                C = (1 - a) * C
+                C[np.diag_indices(self.n)] = 1.
+            self.min_eigenvalue = max(lamb, self.tol)
+        self._cached = C
+        return C.copy()
+
+    def _refresh(self, C):
+        """
+        Smallest eigenvalue of C, by Lanczos iterations started from the previous eigenvector.
+        """
+        self.num_eigen_refreshes += 1
+        if self.n >= LANCZOS_MIN_SIZE:
+            try:
+                d, v = scipy.sparse.linalg.eigsh(C, k=1, which='SA', v0=self._eigvec)
+                self._eigvec = v[:, 0]
+                return float(d[0])
+            except scipy.sparse.linalg.ArpackNoConvergence:
+                pass
+        d, v = scipy.linalg.eigh(C, subset_by_index=(0, 0))
+        self._eigvec = v[:, 0]
+        return float(d[0])
@@ -0,0 +1,211 @@
+# ---------------------------------------------------------------------------------
+# Process pool helpers and the BLAS thread budget
+# ---------------------------------------------------------------------------------
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# environment variables the BLAS / OpenMP runtimes read when they are loaded
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS')
+
+# from this size on, one matrix gains more from threaded BLAS than from more worker processes
+BLAS_MIN_SIZE = 256
+
+# below this much work (count * flops_per_task, ~ size^3 flops per matrix) starting a process pool costs more than it
+# saves
+POOL_MIN_FLOPS = 1e9
+
+
+def num_workers(n_jobs):
+    """
+    Resolve the n_jobs convention used across the package: None or 1 runs in-process, a negative value counts back
+    from the number of cpus (-1 = all cpus).
+
+    @param n_jobs: int or None
+    @return: int >= 1
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+class ThreadBudget(object):
+    """
+    Number of cpus the package may use, shared between worker processes and the BLAS threads of each of them, so
+    that a pool of n_jobs workers runs cpus // n_jobs BLAS threads each instead of a full set of threads per worker
+    (which oversubscribes the machine and can be slower than running serially).
+
+    With n_jobs='auto' the callers (ensemble_chunks, write_ensemble, nearcorr_sequence, randCorrBlock) choose the
+    split from the matrix size and the number of tasks, see plan. The defaults suit a typical machine, run
+    benchmarks/bench_threads.py to find the crossover size of the current one.
+
+    Limiting the BLAS threads of a running process requires threadpoolctl. Without it the limit is only exported
+    through the BLAS_ENV_VARS environment variables of the workers, which a BLAS already loaded (e.g. inherited by
+    fork) ignores.
+
+    @param cpus: number of cpus to use, None for all of them, negative values count back as for n_jobs
+    @param blas_min_size: matrices from this size on get several BLAS threads rather than one worker each
+    @param pool_min_flops: below this much work in total, everything runs in-process
+    """
+    def __init__(self, cpus=None, blas_min_size=BLAS_MIN_SIZE, pool_min_flops=POOL_MIN_FLOPS):
+        self.cpus = num_workers(-1 if cpus is None else cpus)
+        self.blas_min_size = blas_min_size
+        self.pool_min_flops = pool_min_flops
+
+    def __repr__(self):
+        return 'ThreadBudget(cpus=%d, blas_min_size=%d, pool_min_flops=%g)' % (self.cpus, self.blas_min_size,
+                                                                               self.pool_min_flops)
+
+    def plan(self, size, count, n_jobs='auto', batch=1, flops_per_task=None):
+        """
+        Split the budget between processes and BLAS threads.
+
+        With n_jobs='auto': a single process running all the BLAS threads - one big BLAS call at a time - when
+        there is a single task or too little work for a pool, otherwise matrices below blas_min_size get one
+        single-threaded worker per cpu, and larger ones about size / blas_min_size threads per worker. An explicit
+        n_jobs is kept and only the BLAS threads are set.
+
+        @param size: size of the matrices
+        @param count: number of tasks
+        @param n_jobs: 'auto', or the number of processes (see num_workers)
+        @param batch: number of matrices per task
+        @param flops_per_task: work of a task, default batch * size^3 (e.g. one factorization per matrix), larger
+                               for iterative tasks such as a nearcorr solve
+        @return: (number of processes, BLAS threads per process), the latter None when the BLAS is left as it is
+                 (a single process allowed every cpu)
+        """
+        if flops_per_task is None:
+            flops_per_task = batch * float(size) ** 3
+        if n_jobs == 'auto':
+            if self.cpus == 1 or count <= 1 or count * flops_per_task < self.pool_min_flops:
+                workers = 1
+            else:
+                threads = 1 if size < self.blas_min_size else min(self.cpus, -(-size // self.blas_min_size))
+                workers = max(1, min(count, self.cpus // threads))
+        else:
+            workers = num_workers(n_jobs)
+        if workers == 1 and self.cpus == num_workers(-1):
+            return 1, None
+        return workers, max(1, self.cpus // workers)
+
+
+_budget = ThreadBudget()
+
+
+def get_thread_budget():
+    """
+    @return: the ThreadBudget used by the package
+    """
+    return _budget
+
+
+def set_thread_budget(cpus=None, blas_min_size=BLAS_MIN_SIZE, pool_min_flops=POOL_MIN_FLOPS):
+    """
+    Set the ThreadBudget used by the package, see ThreadBudget for the parameters.
+
+    @return: the previous ThreadBudget
+    """
+    global _budget
+    previous, _budget = _budget, ThreadBudget(cpus, blas_min_size, pool_min_flops)
+    return previous
+
+
+@contextmanager
+def thread_budget(cpus=None, blas_min_size=BLAS_MIN_SIZE, pool_min_flops=POOL_MIN_FLOPS):
+    """
+    ThreadBudget in effect within a with block, e.g.
+
+        with thread_budget(cpus=8):
+            nearcorr_sequence(As, n_jobs='auto')
+    """
+    global _budget
+    previous = set_thread_budget(cpus, blas_min_size, pool_min_flops)
+    try:
+        yield _budget
+    finally:
+        _budget = previous
+
+
+def plan_execution(size, count, n_jobs='auto', batch=1, flops_per_task=None):
+    """
+    ThreadBudget.plan of the current budget.
+
+    @return: (number of processes, BLAS threads per process or None)
+    """
+    return _budget.plan(size, count, n_jobs, batch, flops_per_task)
+
+
+@contextmanager
+def blas_thread_limit(limit):
+    """
+    Limit the BLAS threads of the current process within a with block, e.g. for a single large nearcorr alongside
+    other work. A no-op when limit is None or threadpoolctl is not installed.
+
+    @param limit: number of threads or None
+    """
+    if limit is None or threadpool_limits is None:
+        yield
+        return
+    with threadpool_limits(limits=limit, user_api='blas'):
+        yield
+
+
+def _init_worker(blas_threads):
+    """
+    Initializer of the pool workers: BLAS threads of the worker limited to blas_threads.
+    """
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(blas_threads)
+    if threadpool_limits is not None:
+        # kept for the lifetime of the worker
+        threadpool_limits(limits=blas_threads, user_api='blas')
+
+
+def bounded_imap(func, args_iter, n_jobs=1, max_in_flight=None, blas_threads=None):
+    """
+    Ordered, lazy equivalent of map(func, *args) over a process pool which never has more than max_in_flight tasks
+    submitted but not yet consumed, so memory stays bounded however long args_iter is.
+
+    @param func: picklable (module level) function
+    @param args_iter: iterable of argument tuples
+    @param n_jobs: number of worker processes, None or 1 runs serially in the current process
+    @param max_in_flight: maximum number of pending results (default 2 * n_jobs)
+    @param blas_threads: BLAS threads per worker, default the cpus of the thread budget divided among the workers;
+                         when serial, the BLAS threads of the current process during each call (None leaves them)
+    @return: generator of results, in the order of args_iter
+    """
+    n_jobs = num_workers(n_jobs)
+    if n_jobs == 1:
+        for args in args_iter:
+            with blas_thread_limit(blas_threads):
+                res = func(*args)
+            yield res
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_jobs
+    max_in_flight = max(1, max_in_flight)
+    if blas_threads is None:
+        blas_threads = max(1, _budget.cpus // n_jobs)
+
+    pending = deque()
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(blas_threads,)) as pool:
+        try:
+            for args in args_iter:
+                pending.append(pool.submit(func, *args))
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
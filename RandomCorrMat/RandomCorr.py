@@ -2,9 +2,26 @@
 # Generate a random correlations
 # ----------------------------------------------------
 import numpy as np
-import scipy.linalg
 
-def randCorr(size, betaparam=None, m=None):
+from .RandomStreams import check_rng
+from .StructuredCorr import FactorCorr
+
+def _gram_unit_diag(T):
+    """
+    C = TT' for a single matrix T (size x m) or for each matrix of a stack (batch x size x m), with the diagonal set
+    to exactly 1. Batched products are symmetrized explicitly since matmul does not guarantee C == C'.
+    """
+    size = T.shape[-2]
+    if T.ndim == 2:
+        C = np.dot(T, T.T)
+    else:
+        C = np.matmul(T, T.transpose(0, 2, 1))
+        C = 0.5 * (C + C.transpose(0, 2, 1))
+    C[..., np.arange(size), np.arange(size)] = 1.
+    return C
+
+
+def randCorr(size, betaparam=None, m=None, batch=None, rng=None):
     """
     Create a random matrix T from uniform distribution of dimensions size x m (assumed to be 10000)
     normalize the rows of T to lie in the unit sphere  r = r / sqrt(r'r)
@@ -12,29 +29,64 @@ def randCorr(size, betaparam=None, m=None):
 
     A direct implementation of this method however, leads to correlation matrix which is almost diagonal.
 
+    The rows of T are therefore shrunk by sqrt(1 - alpha^2) and alpha is appended as an extra column, with alpha drawn
+    from 2*Beta(betaparam, betaparam)-1, so that RandCorr = TT' + alpha alpha' is a single (batched) product.
+
     @param size: size of the matrix
-    @param lower: lower limit of the uniform distribution used to create the corr matrix
-    @param upper: upper limit of the uniform distribution used to create the corr matrix
-    @return: numpy ndarray, correlation matrix
+    @param betaparam: parameter of the beta distribution of alpha, smaller values give stronger correlations
+    @param m: number of columns of T (default max(2*size, 20))
+    @param batch: number of matrices to draw, None for a single matrix
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy ndarray, correlation matrix (size x size) or a stack of them (batch x size x size)
     """
+    rng = check_rng(rng)
     # m = 1000
     if m is None:
         m = max([2 * size, 20])
     if betaparam is None:
         betaparam = 0.42
-    randomMatrix = np.random.randn(size, m)
+    nb = 1 if batch is None else batch
+    T = np.empty((nb, size, m + 1))
+    T[:, :, :m] = rng.standard_normal((nb, size, m))
     # randomMatrix = np.random.beta(dist_param, dist_param, (size, m))*(upper - lower) + lower
-    norms = np.sum(randomMatrix**2, axis=1)
-    T = np.divide(randomMatrix, np.sqrt(norms).reshape(size,1))
-    alpha = 2 * np.random.beta(betaparam, betaparam, (size, 1)) - 1
-    T = np.multiply(T, np.sqrt(1 - np.abs(alpha) ** 2))
-    c = np.dot(T, T.T)
-    c = np.dot(alpha, alpha.T) + c
-    c[np.diag_indices(size)] = 1.
-    return c
+    alpha = 2 * rng.beta(betaparam, betaparam, (nb, size)) - 1
+    norms = np.sqrt(np.einsum('bij,bij->bi', T[:, :, :m], T[:, :, :m]))
+    T[:, :, :m] *= (np.sqrt(1 - alpha ** 2) / norms)[:, :, None]
+    T[:, :, m] = alpha
+    return _gram_unit_diag(T[0] if batch is None else T)
+
+
+def randCorrOnionCholesky(size, batch=None, rng=None):
+    """
+    Lower triangular Cholesky factor L of a random correlation matrix C = LL' drawn uniformly from the space of
+    correlation matrices with the onion method.
+
+    Growing Corr(dimension=k) = [S q; q' 1] with q = Lw, where S = LL' and w = sqrt(y) * theta (theta uniform on the
+    unit sphere), only appends the row [w', sqrt(1 - y)] to the Cholesky factor of S. The rows are independent of
+    each other so the whole factor is written into one preallocated buffer, and B factors can be drawn at once.
+
+    y ~ Beta(k/2, (size + 1 - k)/2) at the k-th step, which makes C uniform (LKJ with eta = 1).
+
+    @param size: size of the correlation matrix
+    @param batch: number of factors to draw, None for a single factor
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy ndarray, lower triangular (size x size) or (batch x size x size)
+    """
+    rng = check_rng(rng)
+    nb = 1 if batch is None else batch
+    k = np.arange(1, size)
+    y = np.zeros((nb, size))
+    y[:, 1:] = rng.beta(k / 2., (size + 1 - k) / 2., (nb, size - 1))
+
+    L = np.tril(rng.standard_normal((nb, size, size)), -1)
+    norms = np.sqrt(np.einsum('bij,bij->bi', L, L))
+    norms[:, 0] = 1.
+    L *= (np.sqrt(y) / norms)[:, :, None]
+    L[:, np.arange(size), np.arange(size)] = np.sqrt(1 - y)
+    return L[0] if batch is None else L
 
 
-def randCorrOnion(size):
+def randCorrOnion(size, batch=None, rng=None):
     """
     This algorithm samples exactly and very quickly from a uniform distribution over the space of correlation matrices.
 
@@ -42,7 +94,8 @@ def randCorrOnion(size):
 
     Corr(dimension=d) = [Corr(dimension=d-1) q; q 1]
 
-    q is chosen by the algorithm to ensure that it is a valid correlation matrix
+    q is chosen by the algorithm to ensure that it is a valid correlation matrix. The recursion is carried out on the
+    Cholesky factor (see randCorrOnionCholesky), so the only O(n^3) step is the final product LL'.
 
     original paper: https://people.orie.cornell.edu/shane/pubs/NORTAHighD.pdf
     matlab code: https://stats.stackexchange.com/questions/2746/how-to-efficiently-generate-random-positive-semidefinite-correlation-matrices/125017#125017
@@ -51,27 +104,58 @@ def randCorrOnion(size):
     Portfolio, Clustering .. -> Correlation Matrices -> Random Correaltion
 
     @param size: size of the correlation matrix
-    @param betaparam: a parameter controlling the distributions from which the partial correaltion are chosen
-    @return: correlation matrix (size x size)
+    @param batch: number of matrices to draw, None for a single matrix
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: correlation matrix (size x size) or a stack of them (batch x size x size)
     """
-    S = [[1]]
-    for i in range(1, size):
-        k = i + 1
-        if k == size:
-            y = np.random.uniform(0, 1)
-        else:
-            y = np.random.beta((k-1)/2, (size-k)/2)
-        r = np.sqrt(y)
-        theta = np.random.randn(k-1, 1)
-        theta = theta / np.sqrt(np.dot(theta.T, theta))
-        w = r * theta
-        R = scipy.linalg.sqrtm(S)
-        q = np.dot(R, w)
-        S = np.vstack((np.hstack((S, q)),np.hstack((q.T, [[1]]))))
-    return S
-
-
-def randCorrFactor(size, num_factors):
+    return _gram_unit_diag(randCorrOnionCholesky(size, batch, rng))
+
+
+def randCorrLKJ(size, eta=1., batch=None, cholesky=False, rng=None):
+    """
+    Random correlation matrices from the LKJ distribution, density proportional to det(C)^(eta - 1), by the C-vine
+    method of Lewandowski, Kurowicka and Joe (Generating random correlation matrices based on vines and extended
+    onion method, 2009). eta = 1 is uniform (as randCorrOnion), eta > 1 concentrates around the identity and eta < 1
+    favours strong correlations; every off-diagonal entry has the marginal 2 * Beta(b, b) - 1, b = eta - 1 + size/2.
+
+    The partial correlations z_ki of the vine, of variables k < i given the variables before k, are independent with
+    z_ki ~ 2 * Beta(b_k, b_k) - 1, b_k = eta + (size - 2 - k)/2, and are drawn for the whole batch in one beta draw.
+    They map directly to the Cholesky factor of C, L_ik = z_ki sqrt(prod_{l<k} (1 - z_li^2)) and
+    L_ii = sqrt(prod_{l<i} (1 - z_li^2)), by a cumulative product over the batch, so the only O(n^3) step is the
+    final product LL', skipped with cholesky=True.
+
+    @param size: size of the correlation matrix
+    @param eta: concentration parameter, > 0
+    @param batch: number of matrices to draw, None for a single matrix
+    @param cholesky: return the lower triangular Cholesky factors L instead of C = LL'
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy ndarray (size x size) or (batch x size x size), correlation matrices or their Cholesky factors
+    """
+    if eta <= 0:
+        raise ValueError('eta should be positive, got %s' % eta)
+    rng = check_rng(rng)
+    nb = 1 if batch is None else batch
+    rows, cols = np.tril_indices(size, -1)
+    b = eta + (size - 2 - cols) / 2.
+    Z = np.zeros((nb, size, size))
+    Z[:, rows, cols] = 2 * rng.beta(b, b, (nb, len(rows))) - 1
+
+    # norm[:, i, k] = sqrt(prod_{l<=k} (1 - z_li^2)), the norm left in row i after column k, scales column k + 1
+    norm = np.square(Z[:, :, :-1])
+    np.subtract(1, norm, out=norm)
+    np.cumprod(norm, axis=2, out=norm)
+    np.sqrt(norm, out=norm)
+    L = Z
+    L[:, :, 1:] *= norm
+    diag = np.arange(1, size)
+    L[:, 0, 0] = 1.
+    L[:, diag, diag] = norm[:, diag, diag - 1]
+    if cholesky:
+        return L[0] if batch is None else L
+    return _gram_unit_diag(L[0] if batch is None else L)
+
+
+def randCorrFactor(size, num_factors, batch=None, structured=False, rng=None):
     """
     The idea is to randomly generate several (k<d) factor loadings W (random matrix of k×d size),
     form the covariance matrix WW' (which of course will not be full rank) and add to it a
@@ -80,11 +164,26 @@ def randCorrFactor(size, num_factors):
     The resulting covariance matrix can be normalized to become a correlation matrix,
     by letting C=E^(−1/2)*B*E(−1/2), where E is a diagonal matrix with the same diagonal as B.
 
+    Since E = diag(rowsum(W^2) + D), the off-diagonal part of C is simply VV' with V = E^(-1/2)W, so the rows of W are
+    rescaled in place and no n x n diagonal matrices are formed.
+
     @param size: size of the correlation matrix
     @param num_factors: number of factors governing the correlation matrix
-    @return:
+    @param batch: number of matrices to draw, None for a single matrix
+    @param structured: if True return FactorCorr objects (loadings V and uniquenesses D/E, O(size * num_factors)
+                       memory) instead of dense matrices, see StructuredCorr.FactorCorr
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: correlation matrix (size x size) or a stack of them (batch x size x size), FactorCorr or a list of them
+             if structured
     """
-    W = np.random.normal(size=(size, num_factors))
-    S = np.dot(W, W.T) + np.diag(np.random.rand(1, num_factors))
-    S = np.dot(np.diag(1 / np.sqrt(np.diag(S))), np.dot(S, np.diag(1 / np.sqrt(np.diag(S)))))
-    return S
\ No newline at end of file
+    rng = check_rng(rng)
+    nb = 1 if batch is None else batch
+    W = rng.standard_normal((nb, size, num_factors))
+    D = rng.random((nb, size))
+    E = np.einsum('bij,bij->bi', W, W) + D
+    W /= np.sqrt(E)[:, :, None]
+    if structured:
+        D /= E
+        res = [FactorCorr(W[b], D[b]) for b in range(nb)]
+        return res[0] if batch is None else res
+    return _gram_unit_diag(W[0] if batch is None else W)
@@ -4,7 +4,13 @@
 # Appendix_C_Generating_Random_Correlation_Matrices             (Explains Stewart method for orthogonal transforms)
 # ---------------------------------------------------------------------------------
 
+import time
+
 import numpy as np
+from scipy.linalg import lapack
+
+from .RandomStreams import check_rng
+from .Telemetry import CallStats
 
 def sgn(A):
     """
@@ -28,44 +34,152 @@ def sgn(A):
         raise Exception()
 
 
-def randOrthog(n, f = np.random.randn):
+def randOrthog(n, f=None, batch=None, implicit=False, rng=None):
     """
-    Use stewart's algorithm to create a n x n random orthogona matrix
+    Create a n x n random orthogonal matrix, Haar distributed when f draws standard normals.
+
+    Q comes from the QR decomposition Z = QR of a random n x n matrix Z, with the sign of each column of Q flipped
+    such that R has a positive diagonal (Mezzadri, How to generate random matrices from the classical compact groups,
+    2007). This is equivalent to Stewart's algorithm, which applies the same Householder reflections one at a time,
+    but runs as a single blocked factorization (and a single batched call for a stack).
 
     @param n: size = num rows = num cols
-    @param f: function to use for generating random, np.random.randn or np.random.rand
-    @return: numpy nxn ndarray 
-    """
-    A = np.eye(n) # n x n
-    d = np.zeros((n,1)) # n x 1
-    d[n-1, 0] = sgn(f(1, 1))
-    for k in range(n-2,-1,-1):
-        x = f(n-k, 1)  #n-k+1 x 1
-        s = np.sqrt(np.dot(x.T, x))
-        sg = np.sign(x[0, 0])
-        s = sg*s
-        d[k,0] = -sg
-        x[0, 0] = x[0, 0] + s
-        beta = s * x[0, 0]
-        y = np.dot(x.T, A[k:,:])
-        A[k:, :] = A[k:,:] - x*(y/beta)
-    A = d*A
-    return A
+    @param f: function to use for generating random called as f(batch, n, n), e.g. np.random.rand, default standard
+              normals drawn from rng
+    @param batch: number of matrices to draw, None for a single matrix
+    @param implicit: return a HouseholderOrthog holding the Householder reflections instead of Q itself
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy nxn ndarray, (batch x n x n) ndarray if batch, HouseholderOrthog if implicit
+    """
+    nb = 1 if batch is None else batch
+    Z = check_rng(rng).standard_normal((nb, n, n)) if f is None else f(nb, n, n)
+    if implicit:
+        return HouseholderOrthog(Z, batch)
+    Q, R = np.linalg.qr(Z)
+    Q *= np.where(np.diagonal(R, axis1=1, axis2=2) < 0, -1., 1.)[:, None, :]
+    return Q[0] if batch is None else Q
+
 
+class HouseholderOrthog(object):
+    """
+    Random orthogonal matrices Q = H_1 ... H_n D kept in the compact LAPACK form of the Householder reflections H_i
+    (geqrf) and the signs D, so that Q' diag(lamb) Q can be formed without building Q.
 
-def randMatwithEigenVals(lamb, f = np.random.randn):
+    @param Z: random matrices (batch x n x n)
+    @param batch: None if Z holds a single matrix which should be returned as such
     """
-    Use stewart algorithm to produce a random orthogonal matrix P and then create the matrix with given algorithm
+    def __init__(self, Z, batch=None):
+        self.batch = batch
+        self.n = Z.shape[-1]
+        self._lwork = max(1, 64 * self.n)
+        geqrf, = lapack.get_lapack_funcs(('geqrf',), (Z,))
+        self.qr, self.tau = [], []
+        for z in Z:
+            qr, tau = geqrf(z, lwork=self._lwork)[:2]
+            self.qr.append(qr)
+            self.tau.append(tau)
+        self.signs = np.array([np.where(np.diagonal(qr) < 0, -1., 1.) for qr in self.qr])
+
+    def _unbatch(self, A):
+        return A[0] if self.batch is None else A
+
+    def toarray(self):
+        """
+        @return: the orthogonal matrix Q (n x n), or the stack of them (batch x n x n)
+        """
+        orgqr, = lapack.get_lapack_funcs(('orgqr',), (self.qr[0],))
+        Q = np.array([orgqr(qr, tau, lwork=self._lwork)[0] for qr, tau in zip(self.qr, self.tau)])
+        Q *= self.signs[:, None, :]
+        return self._unbatch(Q)
+
+    def congruence(self, lamb):
+        """
+        Q' diag(lamb) Q, applying the reflections to diag(lamb) from both sides (LAPACK ormqr).
+
+        @param lamb: numpy vector of size n
+        @return: numpy ndarray (n x n), or (batch x n x n)
+        """
+        ormqr, = lapack.get_lapack_funcs(('ormqr',), (self.qr[0],))
+        out = np.empty((len(self.qr), self.n, self.n))
+        for i, (qr, tau) in enumerate(zip(self.qr, self.tau)):
+            A = ormqr('L', 'T', qr, tau, np.diag(lamb), self._lwork, overwrite_c=1)[0]
+            out[i] = ormqr('R', 'N', qr, tau, A, self._lwork, overwrite_c=1)[0]
+        out *= self.signs[:, :, None] * self.signs[:, None, :]
+        return self._unbatch(out)
+
+
+def randMatwithEigenVals(lamb, f=None, batch=None, implicit=False, return_factor=False, rng=None):
+    """
+    Use a random orthogonal matrix P (see randOrthog) and then create the matrix with given eigenvalues
     by using P' diag(lamb) P
 
     @param lamb: eigenvalues (sorted)
-    @param f: function for random generator -- either np.random.randn or np.random.rand
-    @return: numpy ndarray (size = size of eigenvalues)
+    @param f: function for random generator -- see randOrthog
+    @param batch: number of matrices to draw, None for a single matrix
+    @param implicit: apply the Householder reflections of P directly to diag(lamb) instead of forming P
+    @param return_factor: also return the factor T = P' diag(lamb)^1/2 with A = TT' (lamb must be non-negative), e.g.
+                          for CorrelatedSampler.from_factor; P is then formed even if implicit
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy ndarray (size = size of eigenvalues), (batch x n x n) if batch, and T of the same shape if
+             return_factor
 
     """
     n = len(lamb)
-    Q = randOrthog(n, f)
-    return np.dot(Q.T, np.dot(np.diag(lamb), Q))
+    lamb = np.ravel(lamb)
+    if implicit and not return_factor:
+        return randOrthog(n, f, batch, implicit=True, rng=rng).congruence(lamb)
+    if implicit:
+        H = randOrthog(n, f, 1 if batch is None else batch, implicit=True, rng=rng)
+        A, Q = H.congruence(lamb), H.toarray()
+    else:
+        Q = randOrthog(n, f, 1 if batch is None else batch, rng=rng)
+        A = np.matmul(Q.transpose(0, 2, 1) * lamb, Q)
+    if not return_factor:
+        return A[0] if batch is None else A
+    T = Q.transpose(0, 2, 1) * np.sqrt(lamb)
+    return (A[0], T[0]) if batch is None else (A, T)
+
+
+def givensRotation(A, i, j):
+    """
+    Cosine and sine of the Givens rotation in the (i, j) plane such that (G' A G)[i, i] = 1, i.e. t = s/c solves
+
+    (A[j, j] - 1) t^2 - 2 A[i, j] t + (A[i, i] - 1) = 0
+
+    The root of smaller magnitude is computed as (A[i, i] - 1) / (A[i, j] + sign(A[i, j]) sqrt(disc)) which avoids the
+    cancellation of the textbook formula (Davies & Higham). A real root requires (A[i, i] - 1)(A[j, j] - 1) <= 0.
+
+    @param A: numpy ndarray (n x n)
+    @param i: row id
+    @param j: col id
+    @return: (c, s)
+    """
+    Aii = A[i, i]
+    Aij = A[i, j]
+    Ajj = A[j, j]
+    denom = Aij + np.copysign(np.sqrt(Aij**2 - (Aii-1)*(Ajj-1)), Aij)
+    t = (Aii - 1) / denom if denom != 0 else 0.
+    c = 1 / np.sqrt(1 + t**2)
+    s = c * t
+    return c, s
+
+
+def rotateInPlace(A, i, j, c, s):
+    """
+    A <- G' A G for the symmetric matrix A and the Givens rotation G (G[i, i] = G[j, j] = c, G[i, j] = -G[j, i] = s),
+    updating only rows and columns i and j: O(n) instead of two dense n x n products.
+
+    @param A: symmetric numpy ndarray (n x n), modified in place
+    @return: A
+    """
+    ai, aj = A[i, :].copy(), A[j, :].copy()
+    A[i, :] = c * ai - s * aj
+    A[j, :] = s * ai + c * aj
+    ai, aj = A[:, i].copy(), A[:, j].copy()
+    A[:, i] = c * ai - s * aj
+    A[:, j] = s * ai + c * aj
+    A[j, i] = A[i, j]
+    return A
 
 
 def applyGivens(A, i, j):
@@ -82,71 +196,69 @@ def applyGivens(A, i, j):
     @param j: col id
     @return:  A with the Givens rotation
     """
-    Aii = A[i, i]
-    Aij = A[i, j]
-    Ajj = A[j, j]
-    t = (Aij + np.sqrt(Aij**2 - (Aii-1)*(Ajj-1))) / (Ajj-1)
-    c = 1 / np.sqrt(1 + t**2)
-    s = c * t
-    G = np.eye(A.shape[0])
-    G[i, i] = c
-    G[i, j] = s
-    G[j, i] = -s
-    G[j, j] = c
-    return np.dot(G.T, np.dot(A, G))
+    c, s = givensRotation(A, i, j)
+    return rotateInPlace(np.array(A, dtype=np.float64), i, j, c, s)
 
 
-def randCorrGivenEgienvalues(lamb, f = np.random.randn):
+def randCorrGivenEgienvalues(lamb, f=None, decimals=4, tol=1e-12, callback=None, full_output=False, rng=None):
     """
     Create a random matrix with eigenvlaues lamb and then apply Givens rotations to convert the matrix to a corr matrix
 
+    Each rotation pairs a diagonal entry below 1 with one above 1 and sets the first one to 1, so at most n-1
+    rotations are needed. The rotations are applied in place (O(n) each) and the indices below/above 1 are kept in
+    two stacks, which makes the whole loop O(n^2).
+
     @param lamb: numpy vector (sorted)
-    @param f: function for random number generator, either np.random.randn or np.random.rand
-    @return: numpy ndarray (corr mat)
+    @param f: function for random number generator -- see randOrthog
+    @param decimals: number of decimals the result is rounded to, None for full precision
+    @param tol: diagonal entries within tol of 1 are considered converged
+    @param callback: function called after every rotation with the CallStats of the call, whose residual is then
+                     the number of diagonal entries left away from 1 and info['pair'] the pair (i, j) of rotated
+                     indices; the rotations stop when it returns True
+    @param full_output: if True also return the CallStats: number of rotations, the number of diagonal entries left
+                        away from 1 after each of them (residuals), residual max |diag - 1| before the
+                        diagonal is reset to 1, converged if all the diagonal entries were within tol of 1, and the
+                        time spent building the matrix with eigenvalues lamb ('congruence') and rotating ('givens')
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: numpy ndarray (corr mat), or (corr mat, CallStats) if full_output
     """
+    stats = CallStats('randCorrGivenEgienvalues')
     n = len(lamb)
-    lamb = np.reshape(lamb, (1, len(lamb)))
+    lamb = np.ravel(lamb)
     lamb = n * lamb / np.sum(lamb)
 
-    corr = randMatwithEigenVals(np.ravel(lamb), f)
+    start = time.perf_counter()
+    corr = randMatwithEigenVals(lamb, f, rng=rng)
     corr = (corr + corr.T)/2
-    n_iters = 0
-    while np.sum(corr[np.diag_indices(n)]) !=n:
-        corr = randMatwithEigenVals(np.ravel(lamb))
-        corr = (corr + corr.T) / 2
-        n_iters += 1
-        if n_iters >20:
-            raise Exception('Could Not Construct a valid corr matrix such that trace(corr) == n')
-
-    convergence= False
-    iter = 0
-    while not convergence :
-        if iter > n:
-            break
-        # Collect the diagonal and ensure that trace(corr) = n
-        d = corr[np.diag_indices(n)]
-        if np.abs(np.sum(d) - n)>1e-6:
-            raise Exception('trace of corr is not equal to n, trace = %s, diagnal terms = [%s], iteration = %s' % (np.sum(d), d, iter))
+    stats.add_time('congruence', time.perf_counter() - start)
 
-        if all(abs(d-1) < 1e-6):
-            convergence = True
+    d = corr[np.diag_indices(n)]
+    if np.abs(np.sum(d) - n) > 1e-6:
+        raise Exception('trace of corr is not equal to n, trace = %s, diagnal terms = [%s]' % (np.sum(d), d))
+    below = [k for k in range(n) if d[k] < 1 - tol]
+    above = [k for k in range(n) if d[k] > 1 + tol]
+
+    start = time.perf_counter()
+    while below and above:
+        i = below.pop()
+        j = above.pop()
+        trace_sum = corr[i, i] + corr[j, j]
+        c, s = givensRotation(corr, i, j)
+        rotateInPlace(corr, i, j, c, s)
+        corr[i, i] = 1.
+        corr[j, j] = trace_sum - 1.
+        if corr[j, j] > 1 + tol:
+            above.append(j)
+        elif corr[j, j] < 1 - tol:
+            below.append(j)
+        stats.info['pair'] = (i, j)
+        if stats.iteration(len(below) + len(above), callback):
             break
-        else:
-            # Apply Givens Transformation
-            idx = np.arange(n)
-            idxgt1 = idx[d>1]
-            idxlt1 = idx[d<1]
-
-            i = idxlt1[0]
-            j = idxgt1[-1]
-            if i > j:
-                i = idxgt1[0]
-                j = idxlt1[-1]
-            trace_sum = corr[i, i] + corr[j, j]
-            corr = applyGivens(corr, i, j)
-            corr[i, i] = 1.
-            corr[j, j] = trace_sum - 1.
-        iter += 1
-    C = np.round(corr,4)
+    stats.add_time('givens', time.perf_counter() - start)
+    residual = float(np.max(np.abs(np.diagonal(corr) - 1))) if n else 0.
+    stats.info.pop('pair', None)
+    stats.finish(residual, residual <= tol)
+
+    C = corr if decimals is None else np.round(corr, decimals)
     C[np.diag_indices(C.shape[0])] = 1
-    return C
\ No newline at end of file
+    return (C, stats) if full_output else C
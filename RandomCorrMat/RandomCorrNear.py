@@ -1,27 +1,205 @@
+import time
+
 import numpy as np
 import numpy.linalg as LA
+import scipy.linalg
+import scipy.sparse.linalg
+
+from .FactorCache import cached_eigh
+from .Parallel import bounded_imap, plan_execution
+from .Telemetry import CallStats
+
+# below this size a full eigendecomposition is always cheaper than Lanczos iterations
+PARTIAL_MIN_SIZE = 500
+# Lanczos iterations are abandoned for the dense path beyond this fraction of negative eigenvalues
+PARTIAL_MAX_FRACTION = 0.05
+
+
+def proj_spd(A, method='full'):
+    """
+    Projection of the symmetric matrix A onto the positive semidefinite cone, A_+ = A - V diag(d) V' where (d, V) are
+    the negative eigenpairs of A.
 
+    @param A: symmetric numpy array (n x n)
+    @param method: 'full' - dense eigendecomposition
+                   'partial' - only the negative eigenpairs by Lanczos iterations (scipy.sparse.linalg.eigsh), falls
+                   back to 'full' if there are more than PARTIAL_MAX_FRACTION * n of them
+                   'auto' - see SpdProjector
+    @return: numpy array (n x n)
+    """
+    return SpdProjector(method)(A)
+
+
+class SpdProjector(object):
+    """
+    Projection onto the PSD cone of a sequence of nearby symmetric matrices, such as the iterates of nearcorr.
 
-def proj_spd(A):
+    The number of negative eigenvalues of the previous matrix is kept: when it is small only the negative part of
+    the spectrum is computed, either by the dense MRRR solver restricted to negative eigenvalues (LAPACK syevr) or
+    by Lanczos iterations, and A is corrected by a low rank update instead of being rebuilt from all eigenpairs.
+    With method='auto', both are timed on the first iterations and the cheaper one is used afterwards; Lanczos is
+    only considered for n >= PARTIAL_MIN_SIZE.
+
+    @param method: 'full', 'partial' or 'auto'
+    @param stats: CallStats to which the time spent in eigendecompositions and matrix products is added, or None
+    @param cache_first: if True the first matrix is the caller's own, its eigendecomposition goes through the
+                        factorization cache (see FactorCache.enable_cache)
+    """
+    def __init__(self, method='auto', stats=None, cache_first=False):
+        if method not in ('full', 'partial', 'auto'):
+            raise ValueError("method should be 'full', 'partial' or 'auto', got %s" % method)
+        self.method = method
+        self.num_negative = None
+        self.timings = {}
+        self.stats = stats
+        self.cache_first = cache_first
+
+    def _choose(self, n):
+        if self.method != 'auto':
+            return self.method
+        if n < PARTIAL_MIN_SIZE or self.num_negative is None or self.num_negative > PARTIAL_MAX_FRACTION * n:
+            return 'full'
+        for method in ('partial', 'full'):
+            if method not in self.timings:
+                return method
+        return min(self.timings, key=self.timings.get)
+
+    def __call__(self, A):
+        method = self._choose(A.shape[0])
+        informed = self.num_negative is not None
+        start = time.perf_counter()
+        res = None
+        if method == 'partial':
+            res = _proj_spd_partial(A, self.num_negative, self.stats)
+            if res is None:
+                method = 'full'
+        if res is None:
+            res = _proj_spd_full(A, self.num_negative, self.stats, self.cache_first and not informed)
+        if informed:
+            self.timings[method] = time.perf_counter() - start
+        A, self.num_negative = res
+        return A
+
+
+def _proj_spd_full(A, num_negative, stats=None, cached=False):
+    """
+    Dense eigendecomposition, restricted to the negative eigenvalues when num_negative says there are few of them,
+    looked up in the factorization cache when cached (A is then a matrix of the caller, not an iterate).
+    Returns (A_+, number of negative eigenvalues).
+    """
     # NOTE: the input matrix is assumed to be symmetric
-    d, v = np.linalg.eigh(A)
-    A = (v * np.maximum(d, 0)).dot(v.T)
+    n = A.shape[0]
+    start = time.perf_counter()
+    if num_negative is not None and num_negative <= n // 2:
+        d, v = scipy.linalg.eigh(A, subset_by_value=(-np.inf, 0), driver='evr')
+        negative_only = True
+    else:
+        d, v = cached_eigh(A) if cached else np.linalg.eigh(A)
+        negative_only = False
+    if stats is not None:
+        stats.add_time('eigh', time.perf_counter() - start)
+        start = time.perf_counter()
+    neg = d < 0
+    num_neg = int(np.sum(neg))
+    if negative_only or num_neg <= n // 2:
+        A = A - (v[:, neg] * d[neg]).dot(v[:, neg].T)
+    else:
+        A = (v * np.maximum(d, 0)).dot(v.T)
     A = (A + A.T) / 2
-    return A
+    if stats is not None:
+        stats.add_time('matmul', time.perf_counter() - start)
+    return A, num_neg
+
+
+def _proj_spd_partial(A, num_negative, stats=None):
+    """
+    Negative eigenpairs of A by Lanczos iterations: the k smallest eigenvalues are computed, with k doubled until one
+    of them is non-negative. Returns (A_+, number of negative eigenvalues), or None when k would exceed
+    PARTIAL_MAX_FRACTION * n or the iterations do not converge.
+    """
+    n = A.shape[0]
+    max_k = int(PARTIAL_MAX_FRACTION * n)
+    k = (num_negative or 0) + 5
+    while k <= max_k:
+        start = time.perf_counter()
+        try:
+            d, v = scipy.sparse.linalg.eigsh(A, k=k, which='SA', ncv=min(n, max(2 * k + 1, 40)))
+        except scipy.sparse.linalg.ArpackNoConvergence:
+            return None
+        finally:
+            if stats is not None:
+                stats.add_time('lanczos', time.perf_counter() - start)
+        if d.max() >= 0:
+            start = time.perf_counter()
+            neg = d < 0
+            A = A - (v[:, neg] * d[neg]).dot(v[:, neg].T)
+            A = (A + A.T) / 2
+            if stats is not None:
+                stats.add_time('matmul', time.perf_counter() - start)
+            return A, int(np.sum(neg))
+        k *= 2
+    return None
 
 def proj_unitdiag(A):
     n = A.shape[0]
     A[np.diag_indices(n)] = 1
     return A
 
-def nearcorr(A, max_iterations=100, weights=None):
+
+class NearCorrResult(object):
+    """
+    Outcome of nearcorr(..., full_output=True).
+
+    X: the correlation matrix
+    method: 'alternating' or 'newton'
+    iterations: number of iterations carried out
+    residual: final value of the stopping criterion of the method
+    converged: True if residual <= tol was reached within max_iterations
+    ds: Dykstra correction of the alternating projections
+    y: dual variables of the unit diagonal constraint (the Newton iterate)
+    stats: CallStats of the call - wall time, time spent in eigendecompositions and matrix products, residual of
+           every iteration
+
+    ds and y are both available whichever method produced the result, so it can be passed as warm_start to either.
+    """
+    def __init__(self, X, method, iterations, residual, converged, ds, y, stats=None):
+        self.X = X
+        self.method = method
+        self.iterations = iterations
+        self.residual = residual
+        self.converged = converged
+        self.ds = ds
+        self.y = y
+        self.stats = stats
+
+    def __repr__(self):
+        return 'NearCorrResult(method=%s, iterations=%s, residual=%.3e, converged=%s)' % (
+            self.method, self.iterations, self.residual, self.converged)
+
+
+def nearcorr(A, max_iterations=100, weights=None, method='alternating', tol=None, warm_start=None,
+             full_output=False, projection='auto', callback=None):
     """
     Finds the nearest correlation matrix to the symmetric matrix A.
 
     @param A: symmetric numpy array (n x n)
     @param max_iterations: is the maximum number of iterations (default 100)
     @param weights: weights for the rows of the matrix A
-    @return: Correlation matrix
+    @param method: 'alternating' - alternating projections with Dykstra's correction (Higham), linear convergence
+                   'newton' - semismooth Newton method on the dual problem (Qi & Sun), quadratic convergence
+    @param tol: stopping tolerance, the relative change of the iterates for 'alternating' (default eps * n) and the
+                relative norm of the dual gradient ||diag(X) - 1|| / ||1|| for 'newton' (default 1e-9)
+    @param warm_start: NearCorrResult of a previous call (e.g. on a nearby matrix) to start the iterations from
+    @param full_output: if True return a NearCorrResult with iteration count, residual and convergence flag
+    @param projection: projection onto the PSD cone of the 'alternating' method, 'full', 'partial' or 'auto' (see
+                       proj_spd and SpdProjector). For nearly PSD inputs only the few negative eigenpairs are computed
+                       after the first iteration, and A is corrected by a low rank update.
+                       For an unweighted solve without warm_start, the first eigendecomposition of either method is
+                       of A itself and goes through the factorization cache when it is enabled (see
+                       FactorCache.enable_cache); the iterates never do.
+    @param callback: function called after every iteration with the CallStats of the call (iterations, residual,
+                     timings so far), the iterations stop when it returns True
+    @return: Correlation matrix, or NearCorrResult if full_output
 
     Note:
     This is a partial working port of the original MATLAB code by N. J. Higham,
@@ -29,40 +207,304 @@ def nearcorr(A, max_iterations=100, weights=None):
 
     Reference:  N. J. Higham, Computing the nearest correlation matrix---A problem from finance. IMA J. Numer. Anal.,
     22(3):329-343, 2002.
+    H. Qi and D. Sun, A quadratically convergent Newton method for computing the nearest correlation matrix.
+    SIAM J. Matrix Anal. Appl., 28(2):360-385, 2006.
+    """
+    A = np.asarray(A, dtype=np.float64)
+    n = np.shape(A)[0]
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    # only a cold, unweighted solve starts from A itself, whose factors others may look up
+    cached = warm_start is None and np.all(weights == 1)
+
+    if method == 'alternating':
+        tol = np.finfo(np.float64).eps * n if tol is None else tol
+        res = _nearcorr_alternating(A, weights, tol, max_iterations, warm_start, projection, callback, cached)
+    elif method == 'newton':
+        tol = 1e-9 if tol is None else tol
+        res = _nearcorr_newton(A, weights, tol, max_iterations, warm_start, callback, cached)
+    else:
+        raise ValueError("method should be 'alternating' or 'newton', got %s" % method)
+    return res if full_output else res.X
+
+
+class NearCorrSequenceResult(object):
+    """
+    Outcome of nearcorr_sequence(..., full_output=True).
+
+    X: the correlation matrices (T x n x n)
+    iterations: number of iterations of each solve (T,)
+    residuals: final residual of each solve (T,)
+    converged: convergence flag of each solve (T,)
+    wall_time: seconds spent in the call
     """
-    eps = np.finfo(np.float64).eps
-    tol = eps * np.shape(A)[0] * np.ones(2)
-    weights = np.ones(np.shape(A)[0]) if not weights else weights
-    X = Y = A
-    rel_diffY = rel_diffX = rel_diffXY = np.inf
-    ds = np.zeros_like(A)
-    Whalf = np.sqrt(np.outer(weights, weights))
+    def __init__(self, X, iterations, residuals, converged, wall_time):
+        self.X = X
+        self.iterations = iterations
+        self.residuals = residuals
+        self.converged = converged
+        self.wall_time = wall_time
+
+    @property
+    def total_iterations(self):
+        return int(np.sum(self.iterations))
+
+    @property
+    def matrices_per_second(self):
+        return len(self.X) / self.wall_time if self.wall_time > 0 else np.inf
+
+    def __repr__(self):
+        return 'NearCorrSequenceResult(matrices=%d, total_iterations=%d, converged=%d/%d, %.1f matrices/s)' % (
+            len(self.X), self.total_iterations, np.sum(self.converged), len(self.X), self.matrices_per_second)
+
+
+def nearcorr_sequence(As, chunk_size=None, n_jobs=1, warm=True, full_output=False, max_in_flight=None, **kwargs):
+    """
+    nearcorr of every matrix of a sequence, such as rolling window correlation estimates, where consecutive matrices
+    differ only slightly.
+
+    Each solve is warm started from the solution of the previous matrix (its Dykstra correction for 'alternating',
+    its dual variables for 'newton'), which usually cuts the number of iterations several fold for smooth
+    sequences. The sequence is cut into contiguous chunks, solved independently over a pool of n_jobs processes;
+    only the first matrix of each chunk starts cold.
+
+    @param As: numpy ndarray (T x n x n)
+    @param chunk_size: number of consecutive matrices per task (default T / n_jobs, one chunk per worker)
+    @param n_jobs: number of worker processes, None or 1 runs serially, -1 uses all cpus, 'auto' chooses between
+                   worker processes and BLAS threads from n and T (see Parallel.ThreadBudget)
+    @param warm: warm start each solve from the previous one
+    @param full_output: if True return a NearCorrSequenceResult with iterations, residuals and throughput
+    @param max_in_flight: maximum number of pending chunks (default 2 * n_jobs)
+    @param kwargs: arguments of nearcorr, e.g. method='newton', max_iterations, weights, tol
+    @return: correlation matrices (T x n x n), or NearCorrSequenceResult if full_output
+    """
+    start = time.perf_counter()
+    As = np.asarray(As, dtype=np.float64)
+    T = len(As)
+    n = As.shape[-1]
+    # a solve costs tens of eigendecompositions of ~10 n^3 flops
+    n_jobs, blas_threads = plan_execution(n, T, n_jobs, flops_per_task=100. * n ** 3)
+    if chunk_size is None:
+        chunk_size = max(1, -(-T // n_jobs))
+    tasks = ((As[i:i + chunk_size], warm, kwargs) for i in range(0, T, chunk_size))
+    X = np.empty_like(As)
+    iterations = np.zeros(T, dtype=np.int64)
+    residuals = np.zeros(T)
+    converged = np.zeros(T, dtype=bool)
+    i = 0
+    for x, its, res, conv in bounded_imap(_nearcorr_chunk, tasks, n_jobs=n_jobs, max_in_flight=max_in_flight,
+                                          blas_threads=blas_threads):
+        X[i:i + len(x)], iterations[i:i + len(x)], residuals[i:i + len(x)], converged[i:i + len(x)] = \
+            x, its, res, conv
+        i += len(x)
+    if not full_output:
+        return X
+    return NearCorrSequenceResult(X, iterations, residuals, converged, time.perf_counter() - start)
+
+
+def _nearcorr_chunk(As, warm, kwargs):
+    """
+    Warm started nearcorr over the consecutive matrices As, returns (X, iterations, residuals, converged).
+    """
+    results = []
+    previous = None
+    for A in As:
+        previous = nearcorr(A, warm_start=previous if warm else None, full_output=True, **kwargs)
+        results.append(previous)
+    return (np.array([r.X for r in results]), [r.iterations for r in results], [r.residual for r in results],
+            [r.converged for r in results])
+
+
+def _nearcorr_alternating(A, weights, tol, max_iterations, warm_start, projection, callback, cached=False):
+    """
+    Alternating projections onto the PSD cone (with Dykstra's correction ds) and onto the unit diagonal matrices.
+
+    The iterates satisfy offdiag(Y - ds) = offdiag(A), so a warm start keeps the correction ds of the previous solve
+    and starts from Y = A + ds. With cached, the first projection (of A itself) goes through the factorization cache.
+    """
+    stats = CallStats('nearcorr/alternating')
+    weighted = np.any(weights != 1)
+    Whalf = np.sqrt(np.outer(weights, weights)) if weighted else None
+    if warm_start is None:
+        ds = np.zeros_like(A)
+        Y = A
+    else:
+        ds = warm_start.ds
+        Y = proj_unitdiag(A + ds)
+    X = Y
+    rel_diff = np.inf
+    projector = SpdProjector(projection, stats, cache_first=cached)
 
     iteration = 0
-    while max(rel_diffX, rel_diffY, rel_diffXY) > tol[0]:
+    while rel_diff > tol and iteration < max_iterations:
         iteration += 1
-        if iteration > max_iterations:
-            return X
 
-        Xold = X.copy()
-        R = X - ds
-        R_wtd = Whalf*R
-        X = proj_spd(R_wtd)
-
-        X = X / Whalf
+        Xold = X
+        R = Y - ds
+        if weighted:
+            X = projector(Whalf*R) / Whalf
+        else:
+            X = projector(R)
         ds = X - R
-        Yold = Y.copy()
+        Yold = Y
         Y = proj_unitdiag(X)
         normY = LA.norm(Y, 'fro')
         rel_diffX = LA.norm(X - Xold, 'fro') / LA.norm(X, 'fro')
         rel_diffY = LA.norm(Y - Yold, 'fro') / normY
         rel_diffXY = LA.norm(Y - X, 'fro') / normY
+        rel_diff = max(rel_diffX, rel_diffY, rel_diffXY)
+        if stats.iteration(rel_diff, callback):
+            break
 
-    return X
+    y = weights * np.diag(Y - ds - A)
+    stats.info['num_negative'] = projector.num_negative
+    stats.finish(rel_diff, rel_diff <= tol)
+    return NearCorrResult(X, 'alternating', iteration, rel_diff, rel_diff <= tol, ds, y, stats)
 
 
+def _nearcorr_newton(A, weights, tol, max_iterations, warm_start, callback, cached=False):
+    """
+    Semismooth Newton method of Qi & Sun on the dual of the W-weighted problem
 
+        min 0.5 ||W^1/2 (X - A) W^1/2||^2,  X PSD, diag(X) = 1
 
+    With G = W^1/2 A W^1/2 and b = weights, the dual function is theta(y) = 0.5 ||(G + diag(y))_+||^2 - b'y with
+    gradient F(y) = diag((G + diag(y))_+) - b. Each Newton step is solved with preconditioned conjugate gradients
+    using the generalized Jacobian of F, followed by an Armijo line search on theta. With cached, the first
+    eigendecomposition goes through the factorization cache.
+    """
+    stats = CallStats('nearcorr/newton')
+    n = A.shape[0]
+    wh = np.sqrt(weights)
+    Whalf = np.outer(wh, wh)
+    G = Whalf * A
+    G = (G + G.T) / 2
+    b = weights
+    normb = LA.norm(b)
 
+    if warm_start is None:
+        y = b - np.diag(G)
+    else:
+        y = warm_start.y.copy()
 
+    # cold and unweighted, G + diag(y0) is A with a unit diagonal, i.e. A itself for a correlation-like input
+    start = time.perf_counter()
+    lamb, P = cached_eigh(G + np.diag(y)) if cached else LA.eigh(G + np.diag(y))
+    stats.add_time('eigh', time.perf_counter() - start)
+    theta, Fy = _newton_dual(lamb, P, y, b)
+    residual = LA.norm(Fy) / normb
 
+    iteration = 0
+    while residual > tol and iteration < max_iterations:
+        iteration += 1
+
+        start = time.perf_counter()
+        d = _newton_direction(lamb, P, Fy, residual)
+        stats.add_time('cg', time.perf_counter() - start)
+        slope = np.dot(Fy, d)
+        # close to the solution the decrease of theta is below its rounding error, allow for it
+        slack = 100 * np.finfo(np.float64).eps * max(1., abs(theta))
+        step = 1.
+        for _ in range(30):
+            y_new = y + step * d
+            start = time.perf_counter()
+            lamb_new, P_new = LA.eigh(G + np.diag(y_new))
+            stats.add_time('eigh', time.perf_counter() - start)
+            stats.info['line_search_steps'] = stats.info.get('line_search_steps', 0) + 1
+            theta_new, Fy_new = _newton_dual(lamb_new, P_new, y_new, b)
+            if theta_new <= theta + 1e-4 * step * slope + slack:
+                break
+            step /= 2
+        y, lamb, P, theta, Fy = y_new, lamb_new, P_new, theta_new, Fy_new
+        residual = LA.norm(Fy) / normb
+        if stats.iteration(residual, callback):
+            break
+
+    start = time.perf_counter()
+    X = (P * np.maximum(lamb, 0)).dot(P.T)
+    X = (X + X.T) / 2
+    X = X / Whalf
+    ds = X - (A + np.diag(y / weights))
+    # rescale the remaining error of the diagonal away, D^-1/2 X D^-1/2 stays PSD
+    d = np.sqrt(np.diag(X))
+    X = X / np.outer(d, d)
+    X = proj_unitdiag(X)
+    stats.add_time('matmul', time.perf_counter() - start)
+    stats.finish(residual, residual <= tol)
+    return NearCorrResult(X, 'newton', iteration, residual, residual <= tol, ds, y, stats)
+
+
+def _newton_dual(lamb, P, y, b):
+    """
+    Dual function theta(y) and its gradient F(y) from the eigendecomposition P diag(lamb) P' of G + diag(y).
+    """
+    lamb_plus = np.maximum(lamb, 0)
+    theta = 0.5 * np.dot(lamb_plus, lamb_plus) - np.dot(b, y)
+    Fy = np.einsum('ij,j,ij->i', P, lamb_plus, P) - b
+    return theta, Fy
+
+
+def _newton_direction(lamb, P, Fy, residual):
+    """
+    Solve V d = -F(y) by preconditioned conjugate gradients, V being the generalized Jacobian
+
+        V h = diag(P (Omega o (P' diag(h) P)) P')
+
+    where Omega is 1 on pairs of positive eigenvalues, 0 on pairs of non-positive ones and lamb_i / (lamb_i - lamb_j)
+    on the mixed pairs. Only the mixed block and the smaller of the two diagonal blocks are needed, so a product costs
+    O(n^2 min(r, n - r)) with r the number of positive eigenvalues.
+    """
+    n = len(lamb)
+    pos = lamb > 0
+    P1, P2 = P[:, pos], P[:, ~pos]
+    lamb1, lamb2 = lamb[pos], lamb[~pos]
+    Omega12 = lamb1[:, None] / (lamb1[:, None] - lamb2[None, :])
+    # products with Omega when there are few positive eigenvalues, with 1 - Omega otherwise
+    small_positive = len(lamb1) <= len(lamb2)
+    if small_positive:
+        Pd, M12 = P1, Omega12
+    else:
+        Pd, M12 = P2, 1 - Omega12
+
+    def matvec(h):
+        Hd = np.dot((Pd * h[:, None]).T, Pd)
+        H12 = np.dot((P1 * h[:, None]).T, P2)
+        v = np.einsum('ij,ij->i', np.dot(Pd, Hd), Pd) + 2 * np.einsum('ij,ij->i', np.dot(P1, M12 * H12), P2)
+        v = v if small_positive else h - v
+        return v + 1e-10 * h
+
+    Q1, Q2 = P1 ** 2, P2 ** 2
+    if small_positive:
+        c = np.sum(Q1, axis=1) ** 2 + 2 * np.einsum('ij,ij->i', np.dot(Q1, Omega12), Q2)
+    else:
+        c = 1 - np.sum(Q2, axis=1) ** 2 - 2 * np.einsum('ij,ij->i', np.dot(Q1, 1 - Omega12), Q2)
+    c = np.maximum(c, 1e-8)
+
+    return _pcg(matvec, -Fy, c, max(min(1e-2, residual), 1e-12), max(n, 50))
+
+
+def _pcg(matvec, rhs, precond, tol, max_iterations):
+    """
+    Preconditioned conjugate gradients for the symmetric positive definite system matvec(x) = rhs with the diagonal
+    preconditioner precond, stopping when ||r|| <= tol ||rhs||.
+    """
+    x = np.zeros_like(rhs)
+    r = rhs.copy()
+    z = r / precond
+    p = z.copy()
+    rz = np.dot(r, z)
+    stop = tol * LA.norm(rhs)
+    for _ in range(max_iterations):
+        if LA.norm(r) <= stop:
+            break
+        q = matvec(p)
+        pq = np.dot(p, q)
+        if pq <= 0:
+            break
+        alpha = rz / pq
+        x += alpha * p
+        r -= alpha * q
+        z = r / precond
+        rz_new = np.dot(r, z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return x if np.any(x) else rhs / precond
@@ -3,26 +3,57 @@
 # ------------------------------------------------------
 
 import numpy as np
-from numpy import linalg as LA
 
 from .RandomCorrMatEigen import *
+from .Diagnostics import min_eigenvalue
+from .RandomStreams import check_rng
 
-def perturb_randCorr(corr_mat):
+def perturb_randCorr(corr_mat, num=None, rng=None):
     """
     If C is a correlation matrix then C+X is a correlation matrix if and only if 2-norm or 1-norm or inf-norm of X is less than the smallest eigenvalue of C.
 
     @param corr_mat: numpy ndarray
-    @return: perturbed correlation matrix
+    @param num: number of perturbations, None for a single matrix (see CorrPerturber to draw repeatedly)
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: perturbed correlation matrix, or a stack of num of them (num x n x n)
     """
+    return CorrPerturber(corr_mat, rng=rng).sample(num)
 
-    # compute the smallest eigenvalue - lambda - of the corr matrix
-    eigenvals = LA.eigvalsh(corr_mat)
-    lamb = min(eigenvals)
-    # Create a random matrix with eigenvalues in [1-lamb, 1+lamb]
-    perturb_eigenvalues = np.random.uniform(1-lamb, 1+lamb, corr_mat.shape[0])
-    A = randMatwithEigenVals(perturb_eigenvalues)
-    # perturbe corr = corr + A - I
-    c = corr_mat + A - np.eye(corr_mat.shape[0])
-    c[np.diag_indices(c.shape[0])]= 1.
-    c = 0.5*(c+c.T)
-    return c
\ No newline at end of file
+
+class CorrPerturber(object):
+    """
+    Random perturbations of a fixed correlation matrix C: C + Q' diag(e) Q - I with Q a random orthogonal matrix and
+    the eigenvalues e uniform in [1 - lamb, 1 + lamb], lamb being the smallest eigenvalue of C.
+
+    lamb is computed once (by shift-invert Lanczos for large matrices, see min_eigenvalue), after which any number of
+    perturbations are drawn as stacks from batched orthogonal matrices. With the factorization cache on (see
+    FactorCache.enable_cache), perturbers of the same matrix share the factorization.
+
+    @param corr_mat: numpy ndarray (n x n)
+    @param method: method of min_eigenvalue, 'auto', 'full', 'lanczos' or 'shift-invert'
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng),
+                the stream all the perturbations are drawn from
+    """
+    def __init__(self, corr_mat, method='auto', rng=None):
+        self.rng = check_rng(rng)
+        self.corr_mat = np.asarray(corr_mat, dtype=np.float64)
+        self.n = self.corr_mat.shape[0]
+        # compute the smallest eigenvalue - lambda - of the corr matrix
+        self.min_eigenvalue = min_eigenvalue(self.corr_mat, method)
+
+    def sample(self, num=None):
+        """
+        @param num: number of perturbations, None for a single matrix
+        @return: perturbed correlation matrix (n x n), or a stack of them (num x n x n)
+        """
+        n, lamb = self.n, self.min_eigenvalue
+        nb = 1 if num is None else num
+        # Create random matrices with eigenvalues in [1-lamb, 1+lamb]
+        perturb_eigenvalues = self.rng.uniform(1-lamb, 1+lamb, (nb, n))
+        Q = randOrthog(n, batch=nb, rng=self.rng)
+        c = np.matmul(Q.transpose(0, 2, 1) * perturb_eigenvalues[:, None, :], Q)
+        # perturbed corr = corr + A - I, the diagonal is reset to 1 anyway
+        c += self.corr_mat
+        c = 0.5 * (c + c.transpose(0, 2, 1))
+        c[:, np.arange(n), np.arange(n)] = 1.
+        return c[0] if num is None else c
@@ -0,0 +1,65 @@
+# ---------------------------------------------------------------------------------
+# Random number streams
+# ---------------------------------------------------------------------------------
+import numpy as np
+
+
+def check_rng(rng=None):
+    """
+    Random generator of the rng= argument of the package.
+
+    @param rng: None - the global numpy.random state (legacy MT19937, seeded by numpy.random.seed)
+                int, sequence of ints or numpy.random.SeedSequence - a new numpy.random.Generator on PCG64
+                numpy.random.Generator or numpy.random.RandomState - used as is
+    @return: numpy.random.Generator or numpy.random.RandomState, both provide the standard_normal, random, normal,
+             uniform and beta draws used across the package
+    """
+    if rng is None:
+        return np.random.mtrand._rand
+    if isinstance(rng, (np.random.Generator, np.random.RandomState)):
+        return rng
+    return np.random.Generator(np.random.PCG64(rng))
+
+
+def as_seed_seq(seed=None):
+    """
+    @param seed: int, sequence of ints, numpy.random.SeedSequence, numpy.random.Generator or RandomState to draw the
+                 entropy from, None draws it from the global numpy.random state (so numpy.random.seed applies)
+    @return: numpy.random.SeedSequence
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if seed is None:
+        seed = check_rng(None)
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(0, 2 ** 31, 4))
+    if isinstance(seed, np.random.RandomState):
+        return np.random.SeedSequence(seed.randint(0, 2 ** 31, 4))
+    return np.random.SeedSequence(seed)
+
+
+def child_seed(seed_seq, index):
+    """
+    @param seed_seq: numpy.random.SeedSequence
+    @param index: index of the child
+    @return: numpy.random.SeedSequence of the index-th child, the same as the index-th of seed_seq.spawn(...)
+    """
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (index,))
+
+
+def spawn_rngs(seed, num, bit_generator='PCG64'):
+    """
+    Independent generators for num thread or process workers.
+
+    Example:
+        rngs = spawn_rngs(42, 8)
+        pool.map(lambda rng: randCorrOnion(100, batch=1000, rng=rng), rngs)
+
+    @param seed: see as_seed_seq
+    @param num: number of generators
+    @param bit_generator: 'PCG64' or 'Philox'
+    @return: list of numpy.random.Generator
+    """
+    bit_generator = {'PCG64': np.random.PCG64, 'Philox': np.random.Philox}[bit_generator]
+    seed_seq = as_seed_seq(seed)
+    return [np.random.Generator(bit_generator(child_seed(seed_seq, i))) for i in range(num)]
@@ -0,0 +1,136 @@
+# ---------------------------------------------------------------------------------
+# Correlated normal and uniform samples from correlation matrices
+# ---------------------------------------------------------------------------------
+import numpy as np
+import scipy.special
+
+from .FactorCache import cached_cholesky, cached_eigh
+from .RandomStreams import check_rng
+from .StructuredCorr import FactorCorr, BlockCorr
+
+# default number of samples per streamed chunk
+DEFAULT_CHUNK_SIZE = 100000
+
+
+class CorrelatedSampler(object):
+    """
+    Samples x = T z, z ~ N(0, I), with covariance C = TT' for a correlation matrix C or a stack of them, streamed in
+    chunks of at most chunk_size samples so that any number of samples can be drawn in bounded memory.
+
+    The factor T is computed once, by a Cholesky factorization, or by an eigendecomposition T = V diag(d_+)^1/2 when
+    C is only positive semidefinite (e.g. the output of nearcorr). Both go through the factorization cache when it
+    is enabled (see FactorCache.enable_cache). Factors the generators already have are used as they are:
+
+        CorrelatedSampler.from_cholesky(randCorrOnionCholesky(n))
+        CorrelatedSampler(randCorrFactor(n, k, structured=True))        # O(nk) per sample
+        CorrelatedSampler(randCorrBlock(sizes, structured=True))        # O(sum n_i^2) per sample
+        CorrelatedSampler.from_factor(randMatwithEigenVals(lamb, return_factor=True)[1])
+
+    Uniform samples are the normal ones mapped through the normal cdf (Gaussian copula), their rank correlations
+    follow from C but their linear correlations are not exactly C.
+
+    Example:
+        sampler = CorrelatedSampler(randCorrOnion(100), chunk_size=10**5)
+        for x in sampler.chunks(10**8, kind='uniform'):
+            ...
+
+    @param corr: numpy ndarray (n x n) or (batch x n x n), FactorCorr, BlockCorr or a list of them
+    @param chunk_size: number of samples per chunk
+    @param tol: eigenvalues down to -tol * largest eigenvalue are treated as 0 when C is not positive definite
+    @param factor: numpy ndarray (n x m) or (batch x n x m), a factor T of C = TT' to use instead of corr
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng),
+                the stream all the chunks are drawn from
+    """
+    def __init__(self, corr=None, chunk_size=DEFAULT_CHUNK_SIZE, tol=1e-10, factor=None, rng=None):
+        self.chunk_size = chunk_size
+        self.rng = check_rng(rng)
+        if factor is not None:
+            T = np.asarray(factor, dtype=np.float64)
+            self.structured = False
+            self.batch = None if T.ndim == 2 else T.shape[0]
+            self.factor = T[None] if T.ndim == 2 else T
+            self.n = T.shape[-2]
+            return
+        structured = (FactorCorr, BlockCorr)
+        if isinstance(corr, structured) or (isinstance(corr, (list, tuple)) and corr and
+                                            isinstance(corr[0], structured)):
+            self.structured = True
+            self.batch = None if isinstance(corr, structured) else len(corr)
+            self.factor = [corr] if self.batch is None else list(corr)
+            self.n = self.factor[0].shape[0]
+            return
+        corr = np.asarray(corr, dtype=np.float64)
+        self.structured = False
+        self.batch = None if corr.ndim == 2 else corr.shape[0]
+        stack = corr[None] if corr.ndim == 2 else corr
+        self.factor = np.array([_factorize(c, tol) for c in stack])
+        self.n = stack.shape[-1]
+
+    @classmethod
+    def from_factor(cls, T, chunk_size=DEFAULT_CHUNK_SIZE, rng=None):
+        """
+        @param T: numpy ndarray (n x m) or (batch x n x m), any factor of the covariance C = TT'
+        @param chunk_size: number of samples per chunk
+        @param rng: see CorrelatedSampler
+        @return: CorrelatedSampler
+        """
+        return cls(chunk_size=chunk_size, factor=T, rng=rng)
+
+    @classmethod
+    def from_cholesky(cls, L, chunk_size=DEFAULT_CHUNK_SIZE, rng=None):
+        """
+        @param L: lower triangular Cholesky factor (n x n) or (batch x n x n), e.g. from randCorrOnionCholesky
+        @param chunk_size: number of samples per chunk
+        @param rng: see CorrelatedSampler
+        @return: CorrelatedSampler
+        """
+        return cls.from_factor(L, chunk_size, rng)
+
+    def __repr__(self):
+        return 'CorrelatedSampler(size=%d, batch=%s, structured=%s)' % (self.n, self.batch, self.structured)
+
+    def chunks(self, num, kind='normal', chunk_size=None):
+        """
+        @param num: total number of samples (per matrix of the stack)
+        @param kind: 'normal' - standard normal marginals, 'uniform' - uniform marginals on [0, 1]
+        @param chunk_size: number of samples per chunk (default that of the sampler)
+        @return: generator of numpy ndarrays (chunk x n), (batch x chunk x n) for a stack
+        """
+        if kind not in ('normal', 'uniform'):
+            raise ValueError("kind should be 'normal' or 'uniform', got %s" % kind)
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, num, chunk_size):
+            x = self._normal(min(chunk_size, num - start))
+            if kind == 'uniform':
+                x = scipy.special.ndtr(x, out=x)
+            yield x[0] if self.batch is None else x
+
+    def sample(self, num, kind='normal'):
+        """
+        All num samples at once, see chunks.
+
+        @return: numpy ndarray (num x n), (batch x num x n) for a stack
+        """
+        if num == 0:
+            return np.empty((0, self.n) if self.batch is None else (self.batch, 0, self.n))
+        return next(self.chunks(num, kind, chunk_size=num))
+
+    def _normal(self, count):
+        if self.structured:
+            return np.array([F.sample(count, self.rng) for F in self.factor])
+        T = self.factor
+        z = self.rng.standard_normal((T.shape[0], count, T.shape[-1]))
+        return np.matmul(z, T.transpose(0, 2, 1))
+
+
+def _factorize(C, tol):
+    """
+    T with C = TT', the Cholesky factor when C is positive definite, V diag(d_+)^1/2 otherwise.
+    """
+    L, info = cached_cholesky(C)
+    if info == 0:
+        return L
+    d, V = cached_eigh(C)
+    if d[0] < -tol * max(abs(d[-1]), 1.):
+        raise ValueError('The matrix is not positive semidefinite, smallest eigenvalue %s' % d[0])
+    return V * np.sqrt(np.maximum(d, 0))
@@ -0,0 +1,91 @@
+# ---------------------------------------------------------------------------------
+# Sparse random correlation matrices, positive definite by construction
+# ---------------------------------------------------------------------------------
+import numpy as np
+import scipy.sparse
+
+from .RandomStreams import check_rng
+
+
+def randCorrSparse(size, nnz_per_row=10, bandwidth=None, method='cholesky', strength=0.9, rng=None):
+    """
+    Random sparse correlation matrix in scipy.sparse CSR format, built in memory proportional to its number of
+    non-zeros, so that e.g. size = 10^5 or 10^6 is within reach.
+
+    The sparsity pattern is either a band (|i - j| <= bandwidth) or random, with about nnz_per_row off-diagonal
+    entries per row. Positive definiteness holds by construction:
+
+    'cholesky' - C = D^-1/2 L L' D^-1/2 with L sparse lower triangular, unit diagonal and normal off-diagonal
+                 entries scaled to an absolute row sum of strength, D = diag(L L'). L is non-singular, so C is
+                 positive definite; for strength < 1 the rows of L are diagonally dominant, so L is well
+                 conditioned. C itself is generally not diagonally dominant and has no cheap certificate of
+                 positive definiteness: isvalid_corr falls through to a sparse Cholesky factorization (CHOLMOD) or
+                 Lanczos iterations for it (see Diagnostics._sparse_pd). C has the pattern of L L': a band stays a
+                 band, a random pattern of k entries per row fills in to about k^2 entries per row.
+    'dominant' - C = I + A with A symmetric, uniform off-diagonal entries scaled so that every row of A has an
+                 absolute sum of at most strength < 1: C is strictly diagonally dominant, its eigenvalues are at
+                 least 1 - strength (Gershgorin), a certificate isvalid_corr checks in O(nnz).
+
+    Example:
+        C = randCorrSparse(10**5, bandwidth=5, method='dominant')
+        isvalid_corr(C), min_eigenvalue(C)
+
+    @param size: size of the matrix
+    @param nnz_per_row: number of off-diagonal entries per row of the random pattern (of L for 'cholesky')
+    @param bandwidth: bandwidth of a banded pattern, None for a random pattern
+    @param method: 'cholesky' or 'dominant'
+    @param strength: absolute sum of the off-diagonal entries per row of L ('cholesky') or upper bound of that of C
+                     ('dominant', must be < 1), the larger the stronger the correlations
+    @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+    @return: scipy.sparse.csr_matrix (size x size)
+    """
+    rng = check_rng(rng)
+    if method == 'cholesky':
+        rows, cols = _lower_pattern(size, nnz_per_row, bandwidth, rng)
+        vals = rng.standard_normal(len(rows))
+        L = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(size, size))
+        L.sum_duplicates()
+        L = scipy.sparse.diags(strength / _row_abs_sum(L)) * L + scipy.sparse.identity(size, format='csr')
+        C = (L * L.T).tocsr()
+        scale = scipy.sparse.diags(1. / np.sqrt(C.diagonal()))
+        C = scale * C * scale
+        # the rounding errors of the product are not symmetric
+        C = ((C + C.T) * 0.5).tocsr()
+    elif method == 'dominant':
+        if not 0 <= strength < 1:
+            raise ValueError('strength should be in [0, 1) for the dominant method, got %s' % strength)
+        # the lower pattern with half the entries per row, mirrored
+        rows, cols = _lower_pattern(size, -(-nnz_per_row // 2), bandwidth, rng)
+        vals = rng.uniform(-1, 1, len(rows))
+        A = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(size, size))
+        A.sum_duplicates()
+        A = (A + A.T).tocoo()
+        # A_ij / max(r_i, r_j) keeps A symmetric with row sums at most 1
+        r = _row_abs_sum(A.tocsr())
+        A.data *= strength / np.maximum(r[A.row], r[A.col])
+        C = (A + scipy.sparse.identity(size)).tocsr()
+    else:
+        raise ValueError("method should be 'cholesky' or 'dominant', got %s" % method)
+    C.setdiag(1.)
+    C.sum_duplicates()
+    return C
+
+
+def _lower_pattern(size, nnz_per_row, bandwidth, rng):
+    """
+    (rows, cols) of the strictly lower triangular pattern: the band of width bandwidth, or nnz_per_row random
+    columns j < i per row i (duplicates are summed by the caller).
+    """
+    if bandwidth is not None:
+        offsets = np.arange(1, min(bandwidth, size - 1) + 1)
+        rows = np.concatenate([np.arange(k, size) for k in offsets]) if len(offsets) else np.zeros(0, dtype=int)
+        return rows, rows - np.repeat(offsets, size - offsets)
+    rows = np.repeat(np.arange(1, size), nnz_per_row)
+    cols = (rng.random(len(rows)) * rows).astype(rows.dtype)
+    return rows, cols
+
+
+def _row_abs_sum(A):
+    r = np.asarray(abs(A).sum(axis=1)).ravel()
+    r[r == 0] = 1.
+    return r
@@ -0,0 +1,241 @@
+# ----------------------------------------------------
+# Correlation matrices kept in structured form
+# ----------------------------------------------------
+import numpy as np
+import scipy.linalg
+
+from .RandomStreams import check_rng
+
+
+class FactorCorr(object):
+    """
+    Correlation matrix of a factor model, C = B B' + diag(D), kept as its loadings B (n x k) and uniquenesses
+    D (n,) - the idiosyncratic variances - so that n can be far too large for the n x n matrix.
+
+    Products, solves and the determinant cost O(nk + k^3) through the k x k capacitance matrix
+    K = I + B' diag(D)^-1 B (Woodbury identity and matrix determinant lemma). The dense matrix is only formed by an
+    explicit call to toarray.
+
+    Example:
+        C = randCorrFactor(50000, 10, structured=True)
+        x = C.solve(b); C.logdet(); returns = C.sample(1000)
+
+    @param loadings: numpy array (n x k)
+    @param uniquenesses: numpy array (n,), positive, 1 - rowsum(B^2) for a correlation matrix
+    """
+    def __init__(self, loadings, uniquenesses):
+        self.loadings = np.asarray(loadings, dtype=np.float64)
+        self.uniquenesses = np.asarray(uniquenesses, dtype=np.float64)
+        self._capacitance = None
+
+    @property
+    def shape(self):
+        n = self.loadings.shape[0]
+        return n, n
+
+    @property
+    def num_factors(self):
+        return self.loadings.shape[1]
+
+    def __repr__(self):
+        return 'FactorCorr(size=%d, num_factors=%d)' % (self.shape[0], self.num_factors)
+
+    def toarray(self):
+        """
+        @return: the dense correlation matrix (n x n), with the diagonal set to exactly 1
+        """
+        B = self.loadings
+        C = np.dot(B, B.T)
+        C[np.diag_indices_from(C)] = 1.
+        return C
+
+    def matvec(self, x):
+        """
+        @param x: numpy array (n,) or (n x m)
+        @return: C x, O(nk) per column
+        """
+        x = np.asarray(x)
+        D = self.uniquenesses if x.ndim == 1 else self.uniquenesses[:, None]
+        return np.dot(self.loadings, np.dot(self.loadings.T, x)) + D * x
+
+    def _factor(self):
+        # Cholesky factor of the capacitance matrix K = I + B' D^-1 B, computed once
+        if self._capacitance is None:
+            BD = self.loadings / self.uniquenesses[:, None]
+            K = np.dot(self.loadings.T, BD)
+            K[np.diag_indices_from(K)] += 1.
+            self._capacitance = scipy.linalg.cho_factor(K, lower=True)
+        return self._capacitance
+
+    def solve(self, b):
+        """
+        C^-1 b by the Woodbury identity, C^-1 = D^-1 - D^-1 B K^-1 B' D^-1.
+
+        @param b: numpy array (n,) or (n x m)
+        @return: numpy array of the shape of b
+        """
+        b = np.asarray(b, dtype=np.float64)
+        D = self.uniquenesses if b.ndim == 1 else self.uniquenesses[:, None]
+        Db = b / D
+        return Db - np.dot(self.loadings, scipy.linalg.cho_solve(self._factor(), np.dot(self.loadings.T, Db))) / D
+
+    def logdet(self):
+        """
+        log det C by the matrix determinant lemma, det C = det(K) prod(D).
+
+        @return: float
+        """
+        L = self._factor()[0]
+        return float(np.sum(np.log(self.uniquenesses)) + 2 * np.sum(np.log(np.diag(L))))
+
+    def sample(self, num, rng=None):
+        """
+        Correlated standard normals, B z + D^1/2 e with z ~ N(0, I_k) and e ~ N(0, I_n), in O(num * nk).
+
+        @param num: number of samples
+        @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+        @return: numpy array (num x n)
+        """
+        rng = check_rng(rng)
+        n, k = self.loadings.shape
+        z = rng.standard_normal((num, k))
+        return np.dot(z, self.loadings.T) + np.sqrt(self.uniquenesses) * rng.standard_normal((num, n))
+
+
+class BlockCorr(object):
+    """
+    Hierarchical correlation matrix of m blocks: the diagonal blocks are correlation matrices C_i (n_i x n_i) and the
+    off-diagonal blocks C_ij = B_ij v_i v_j' are coupled through an m x m correlation matrix B, with
+    v_i = C_i 1 / sqrt(1' C_i 1) the correlations of the block members with the (normalized) block average.
+
+    With L = blockdiag(L_i) the block Cholesky factors and U = blockdiag(u_i), u_i = L_i' 1 / ||L_i' 1||, this is
+
+        C = L M L',  M = I - UU' + U B U'
+
+    where M has the eigenvalues of B on the range of U and 1 elsewhere, so C is positive definite whenever the C_i
+    and B are, det C = det B prod(det C_i), and C = TT' with T = L S, S = I - UU' + U L_B U' (L_B the Cholesky factor
+    of B). Products, solves, the determinant and samples therefore cost O(sum n_i^2 + m^2) per vector once the
+    blocks are factorized, instead of O(n^2) - O(n^3) for the dense matrix, which is only formed by toarray.
+
+    @param blocks: list of m correlation matrices (n_i x n_i), positive definite
+    @param between: correlation matrix (m x m), positive definite
+    @param block_cholesky: list of the lower Cholesky factors of the blocks when already computed
+    """
+    def __init__(self, blocks, between, block_cholesky=None):
+        self.blocks = [np.asarray(C, dtype=np.float64) for C in blocks]
+        self.between = np.asarray(between, dtype=np.float64)
+        if self.between.shape != (len(self.blocks), len(self.blocks)):
+            raise ValueError('between should be %d x %d, one row per block' % (len(self.blocks), len(self.blocks)))
+        if block_cholesky is None:
+            block_cholesky = [block_cholesky_factor(C, 'block %d' % i) for i, C in enumerate(self.blocks)]
+        self.block_cholesky = list(block_cholesky)
+        self.between_cholesky = block_cholesky_factor(self.between, 'between')
+        self.sizes = np.array([len(C) for C in self.blocks])
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.u = []
+        self.v = []
+        for L in self.block_cholesky:
+            u = L.sum(axis=0)
+            u /= np.sqrt(np.dot(u, u))
+            self.u.append(u)
+            self.v.append(np.dot(L, u))
+
+    @property
+    def shape(self):
+        n = int(self.offsets[-1])
+        return n, n
+
+    @property
+    def num_blocks(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        return 'BlockCorr(size=%d, num_blocks=%d, largest_block=%d)' % (self.shape[0], self.num_blocks,
+                                                                      self.sizes.max())
+
+    def _split(self, x):
+        return [x[a:b] for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def toarray(self):
+        """
+        @return: the dense correlation matrix (n x n)
+        """
+        C = np.empty(self.shape)
+        o = self.offsets
+        for i in range(self.num_blocks):
+            for j in range(self.num_blocks):
+                C[o[i]:o[i + 1], o[j]:o[j + 1]] = (self.blocks[i] if i == j else
+                                                   self.between[i, j] * np.outer(self.v[i], self.v[j]))
+        return C
+
+    def matvec(self, x):
+        """
+        C x = blockdiag(C_i) x + V (B - I) V' x with V = blockdiag(v_i).
+
+        @param x: numpy array (n,) or (n x k)
+        @return: numpy array of the shape of x
+        """
+        x = np.asarray(x, dtype=np.float64)
+        xs = self._split(x)
+        w = np.array([np.dot(v, xi) for v, xi in zip(self.v, xs)])
+        w = np.dot(self.between - np.eye(self.num_blocks), w)
+        return np.concatenate([np.dot(C, xi) + np.multiply.outer(v, wi) for C, v, xi, wi in
+                               zip(self.blocks, self.v, xs, w)])
+
+    def solve(self, b):
+        """
+        C^-1 b = L^-T (I - UU' + U B^-1 U') L^-1 b, by triangular solves with the block Cholesky factors.
+
+        @param b: numpy array (n,) or (n x k)
+        @return: numpy array of the shape of b
+        """
+        b = np.asarray(b, dtype=np.float64)
+        ys = [scipy.linalg.solve_triangular(L, bi, lower=True) for L, bi in zip(self.block_cholesky, self._split(b))]
+        w = np.array([np.dot(u, y) for u, y in zip(self.u, ys)])
+        w = scipy.linalg.cho_solve((self.between_cholesky, True), w) - w
+        return np.concatenate([scipy.linalg.solve_triangular(L, y + np.multiply.outer(u, wi), lower=True, trans='T')
+                               for L, u, y, wi in zip(self.block_cholesky, self.u, ys, w)])
+
+    def logdet(self):
+        """
+        log det C = log det B + sum log det C_i.
+
+        @return: float
+        """
+        return float(2 * sum(np.sum(np.log(np.diag(L))) for L in self.block_cholesky + [self.between_cholesky]))
+
+    def factor_matvec(self, z):
+        """
+        T z with C = TT', T = L (I - UU' + U L_B U').
+
+        @param z: numpy array (n,) or (n x k)
+        @return: numpy array of the shape of z
+        """
+        z = np.asarray(z, dtype=np.float64)
+        zs = self._split(z)
+        w = np.array([np.dot(u, zi) for u, zi in zip(self.u, zs)])
+        w = np.dot(self.between_cholesky - np.eye(self.num_blocks), w)
+        return np.concatenate([np.dot(L, zi + np.multiply.outer(u, wi)) for L, u, zi, wi in
+                               zip(self.block_cholesky, self.u, zs, w)])
+
+    def sample(self, num, rng=None):
+        """
+        Correlated standard normals T z with z ~ N(0, I_n), in O(num * sum n_i^2).
+
+        @param num: number of samples
+        @param rng: numpy.random.Generator, seed or None for the global numpy.random state (see RandomStreams.check_rng)
+        @return: numpy array (num x n)
+        """
+        return self.factor_matvec(check_rng(rng).standard_normal((self.shape[0], num))).T
+
+
+def block_cholesky_factor(C, name='block'):
+    """
+    @param C: correlation matrix
+    @param name: name of C in the error message
+    @return: lower Cholesky factor of C, ValueError if C is not positive definite
+    """
+    try:
+        return scipy.linalg.cholesky(C, lower=True)
+    except np.linalg.LinAlgError:
+        raise ValueError('The %s correlation matrix is not positive definite' % name)
@@ -0,0 +1,71 @@
+import time
+
+# --------------------------------------------------------------------------------
+# Per call statistics of the iterative algorithms
+# --------------------------------------------------------------------------------
+
+
+class CallStats(object):
+    """
+    Telemetry of one call to an iterative algorithm (nearcorr, randCorrGivenEgienvalues), e.g. to export to a
+    metrics system and find slow or non-converged inputs.
+
+    name: the algorithm, e.g. 'nearcorr/newton'
+    wall_time: seconds spent in the call
+    timings: seconds spent per kind of work, e.g. {'eigh': ..., 'matmul': ...}
+    iterations: number of iterations carried out
+    residual: current (final once the call returned) value of the stopping criterion
+    residuals: residual after each iteration
+    converged: True if the stopping criterion was met
+    info: algorithm specific values
+
+    An instance is passed to the callback of the algorithms after every iteration, which can stop the iterations
+    by returning True.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.
+        self.timings = {}
+        self.iterations = 0
+        self.residual = None
+        self.residuals = []
+        self.converged = False
+        self.info = {}
+        self._start = time.perf_counter()
+
+    def __repr__(self):
+        return 'CallStats(%s, iterations=%d, residual=%s, converged=%s, wall_time=%.4fs, timings={%s})' % (
+            self.name, self.iterations, self.residual, self.converged, self.wall_time,
+            ', '.join('%s: %.4fs' % item for item in sorted(self.timings.items())))
+
+    def add_time(self, key, seconds):
+        self.timings[key] = self.timings.get(key, 0.) + seconds
+
+    def iteration(self, residual, callback=None):
+        """
+        Record the end of an iteration.
+
+        @param residual: value of the stopping criterion
+        @param callback: function called with this object, or None
+        @return: True if the callback asks to stop
+        """
+        self.iterations += 1
+        self.residual = residual
+        self.residuals.append(residual)
+        return callback is not None and bool(callback(self))
+
+    def finish(self, residual, converged):
+        self.residual = residual
+        self.converged = bool(converged)
+        self.wall_time = time.perf_counter() - self._start
+        return self
+
+    def as_dict(self):
+        """
+        @return: flat dict of the scalar statistics, timings prefixed with 'time_'
+        """
+        res = {'name': self.name, 'wall_time': self.wall_time, 'iterations': self.iterations,
+               'residual': self.residual, 'converged': self.converged}
+        res.update(('time_%s' % key, value) for key, value in self.timings.items())
+        res.update(self.info)
+        return res
@@ -1,6 +1,18 @@
-from .RandomPerturb import perturb_randCorr
-from .RandomCorrNear import nearcorr
-from .RandomCorr import randCorr, randCorrFactor, randCorrOnion
+from .RandomPerturb import perturb_randCorr, CorrPerturber
+from .RandomCorrNear import nearcorr, nearcorr_sequence
+from .RandomCorr import randCorr, randCorrFactor, randCorrLKJ, randCorrOnion, randCorrOnionCholesky
 from .RandomCorrMatEigen import randCorrGivenEgienvalues
-from .Diagnostics import CorrDiagnostics, isPD, isvalid_corr, plot_histogram_off_diagonal
-from .ConstantCorr import constantCorrMat
\ No newline at end of file
+from .Diagnostics import CorrDiagnostics, isPD, isvalid_corr, validate_corr, describe_cause, min_eigenvalue, \
+    OffDiagonalStats, plot_histogram_off_diagonal
+from .ConstantCorr import constantCorrMat
+from .Ensemble import ensemble_chunks
+from .FactorCache import FactorCache, enable_cache, disable_cache, get_cache
+from .EnsembleStore import EnsembleStore, write_ensemble, pack, unpack
+from .Telemetry import CallStats
+from .StructuredCorr import FactorCorr, BlockCorr
+from .RandomCorrBlock import randCorrBlock
+from .SparseCorr import randCorrSparse
+from .Sampler import CorrelatedSampler
+from .OnlineCorr import OnlineCorrEstimator
+from .RandomStreams import check_rng, spawn_rngs
+from .Parallel import ThreadBudget, get_thread_budget, set_thread_budget, thread_budget, blas_thread_limit
@@ -1,5 +1,10 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
+import scipy.sparse
 
 from RandomCorrMat.RandomCorrMat.ConstantCorr import *
 from RandomCorrMat.RandomCorrMat.Diagnostics import *
@@ -7,6 +12,16 @@ from RandomCorrMat.RandomCorrMat.RandomCorr import *
 from RandomCorrMat.RandomCorrMat.RandomCorrMatEigen import *
 from RandomCorrMat.RandomCorrMat.RandomCorrNear import *
 from RandomCorrMat.RandomCorrMat.RandomPerturb import *
+from RandomCorrMat.RandomCorrMat.Ensemble import *
+from RandomCorrMat.RandomCorrMat.FactorCache import *
+from RandomCorrMat.RandomCorrMat.EnsembleStore import *
+from RandomCorrMat.RandomCorrMat.Sampler import *
+from RandomCorrMat.RandomCorrMat.RandomCorrBlock import *
+from RandomCorrMat.RandomCorrMat.StructuredCorr import *
+from RandomCorrMat.RandomCorrMat.RandomStreams import *
+from RandomCorrMat.RandomCorrMat.Parallel import *
+from RandomCorrMat.RandomCorrMat.OnlineCorr import *
+from RandomCorrMat.RandomCorrMat.SparseCorr import *
 
 class TestRandCorr(unittest.TestCase):
     # test diagnostics functions
@@ -22,16 +37,138 @@ class TestRandCorr(unittest.TestCase):
         self.assertFalse(res)
         self.assertEqual(res.cause, ['Not Positive Definite'])
 
+    def test_validate_corr_batch(self):
+        S = np.stack([np.eye(3)] * 5)
+        S[1, 0, 1] = 0.5                          # not symmetric
+        S[2] = [[1, 1, 0.99], [1, 1, 0], [0.99, 0, 1]]  # not PD
+        S[3, 2, 2] = 1 + 1e-9                     # diagonal != 1 and out of bounds, within tolerance
+        S[4, 0, 1] = S[4, 1, 0] = np.nan
+        valid, cause = validate_corr(S)
+        self.assertEqual(list(valid), [True, False, False, False, False])
+        self.assertEqual(cause[1], NOT_SYMMETRIC)
+        self.assertEqual(cause[2], NOT_PD)
+        self.assertEqual(describe_cause(cause[3]), ['Off Diagonal outside [-1, 1]', 'Diagonal != 1'])
+        self.assertTrue(cause[4] & NOT_SYMMETRIC and cause[4] & OFF_DIAGONAL)
+        self.assertTrue(validate_corr(S, tol=1e-8)[0][3])
+        for s, c in zip(S, cause):
+            self.assertEqual(isvalid_corr(s).cause, describe_cause(c))
+
+    def test_validate_corr_blocked(self):
+        # large enough to be checked in several blocks of rows
+        A = randCorrOnion(600)
+        A[550, 3] += 1e-12
+        self.assertEqual(validate_corr(A)[1][0], NOT_SYMMETRIC)
+        self.assertTrue(validate_corr(A, tol=1e-10)[0][0])
+        self.assertTrue(isPD(A))
+
+    def test_off_diagonal_stats(self):
+        S = randCorr(10, batch=300)
+        x = S[:, np.triu_indices(10, 1)[0], np.triu_indices(10, 1)[1]].ravel()
+        stats = OffDiagonalStats(bins=20)
+        stats.update(S[:100])
+        other = OffDiagonalStats(bins=20)
+        for s in S[100:]:
+            other.update(s)
+        stats.merge(other)
+        self.assertEqual(stats.num_matrices, 300)
+        self.assertEqual(stats.count, x.size)
+        self.assertTrue(np.array_equal(stats.counts, np.histogram(x, bins=20, range=(-1, 1))[0]))
+        self.assertAlmostEqual(stats.mean, x.mean(), places=12)
+        self.assertAlmostEqual(stats.variance, x.var(), places=12)
+        self.assertEqual((stats.min, stats.max), (x.min(), x.max()))
+
+    def test_plot_histogram_off_diagonal(self):
+        A = np.array([[1, 1, 0.99], [1, 1, 0], [0.99, 0, 1]])
+        stats = plot_histogram_off_diagonal([randCorr(5, batch=10), A], print_cause=False, plot=False)
+        self.assertEqual((stats.num_matrices, stats.num_invalid), (11, 1))
+
     # Test Random Corr
     def test_random_corr(self):
         A = randCorr(10)
         self.assertTrue(isvalid_corr(A), True)
 
+    def test_random_corr_batch(self):
+        S = randCorr(8, batch=50)
+        self.assertEqual(S.shape, (50, 8, 8))
+        self.assertTrue(S.flags.c_contiguous)
+        self.assertTrue(all(isvalid_corr(s) for s in S))
+
+    def test_random_corr_factor(self):
+        self.assertTrue(isvalid_corr(randCorrFactor(20, 3)))
+        S = randCorrFactor(20, 3, batch=50)
+        self.assertEqual(S.shape, (50, 20, 20))
+        self.assertTrue(all(isvalid_corr(s) for s in S))
+
+    def test_random_corr_factor_structured(self):
+        F = randCorrFactor(30, 4, structured=True)
+        C = F.toarray()
+        self.assertTrue(isvalid_corr(C))
+        self.assertTrue(np.allclose(F.loadings.dot(F.loadings.T) + np.diag(F.uniquenesses), C))
+        b = np.random.randn(30, 3)
+        self.assertTrue(np.allclose(F.matvec(b), C.dot(b)))
+        self.assertTrue(np.allclose(F.matvec(b[:, 0]), C.dot(b[:, 0])))
+        self.assertTrue(np.allclose(F.solve(b), np.linalg.solve(C, b)))
+        self.assertAlmostEqual(F.logdet(), np.linalg.slogdet(C)[1])
+        np.random.seed(0)
+        x = F.sample(200000)
+        self.assertTrue(np.allclose(np.cov(x.T), C, atol=0.02))
+        self.assertEqual(len(randCorrFactor(10, 2, batch=3, structured=True)), 3)
+
+    def test_random_corr_block(self):
+        B = randCorrBlock([3, 5, 4], structured=True, seed=0)
+        C = B.toarray()
+        self.assertTrue(isvalid_corr(C))
+        self.assertTrue(np.allclose(C[3:8, 3:8], B.blocks[1]))
+        b = np.random.randn(12, 2)
+        self.assertTrue(np.allclose(B.matvec(b), C.dot(b)))
+        self.assertTrue(np.allclose(B.solve(b), np.linalg.solve(C, b)))
+        self.assertAlmostEqual(B.logdet(), np.linalg.slogdet(C)[1])
+        T = B.factor_matvec(np.eye(12))
+        self.assertTrue(np.allclose(T.dot(T.T), C))
+        self.assertTrue(np.array_equal(randCorrBlock([3, 5, 4], seed=0, n_jobs=2), C))
+
+    def test_random_corr_block_constant(self):
+        C = randCorrBlock([4, 4], between=np.array([[1, 0.5], [0.5, 1]]), generator='constantCorrMat', rho=0.3)
+        self.assertTrue(isvalid_corr(C))
+        self.assertTrue(np.allclose(C[:4, 4:], 0.5 * 0.3 + 0.5 * 0.7 / 4))
+        self.assertRaises(ValueError, randCorrBlock, [4, 4], generator='constantCorrMat', rho=1.)
+
     def test_random_corr_limits(self):
         A = randCorr(5,lower=-0.25, upper=0.5)
         self.assertTrue(np.min(A)>=-0.25, True)
         self.assertTrue(np.max(A - np.eye(5)) <= 0.5, True)
 
+    def test_random_corr_onion(self):
+        A = randCorrOnion(50)
+        self.assertTrue(isvalid_corr(A))
+
+    def test_random_corr_onion_batch(self):
+        np.random.seed(0)
+        S = randCorrOnion(5, batch=20000)
+        self.assertEqual(S.shape, (20000, 5, 5))
+        self.assertTrue(all(isvalid_corr(s) for s in S[:100]))
+        # uniform over correlation matrices => off-diagonal entries ~ 2*Beta(d/2, d/2)-1 with variance 1/(d+1)
+        iu = np.triu_indices(5, 1)
+        self.assertTrue(np.allclose(S[:, iu[0], iu[1]].var(axis=0), 1. / 6, atol=0.01))
+
+    def test_random_corr_onion_cholesky(self):
+        L = randCorrOnionCholesky(20, batch=3)
+        self.assertTrue(np.allclose(L, np.tril(L)))
+        self.assertTrue(np.allclose(np.einsum('bij,bij->bi', L, L), 1.))
+
+    def test_random_corr_lkj(self):
+        for size, eta in [(4, 1.), (5, 3.), (6, 0.5)]:
+            C = randCorrLKJ(size, eta, batch=20000, rng=size)
+            self.assertTrue(np.all(validate_corr(C)[0]))
+            # the off-diagonal entries are 2 * Beta(b, b) - 1 with b = eta - 1 + size / 2
+            self.assertAlmostEqual(C[:, 0, 1].var(), 1. / (2 * eta + size - 1), delta=0.01)
+            self.assertAlmostEqual(C[:, size - 2, size - 1].var(), 1. / (2 * eta + size - 1), delta=0.01)
+        L = randCorrLKJ(5, 2., cholesky=True, rng=1)
+        self.assertTrue(np.allclose(L, np.tril(L)))
+        self.assertTrue(np.allclose(np.dot(L, L.T), randCorrLKJ(5, 2., rng=1)))
+        self.assertEqual(randCorrLKJ(3, batch=2, cholesky=True).shape, (2, 3, 3))
+        self.assertRaises(ValueError, randCorrLKJ, 3, eta=0.)
+
     # Test Constant Corr
     def test_constant_corr(self):
         A = constantCorrMat(5, 0.99)
@@ -42,6 +179,23 @@ class TestRandCorr(unittest.TestCase):
         Q = randOrthog(10)
         self.assertTrue(np.allclose(np.dot(Q.T, Q), np.eye(10), rtol=1e-05, atol=1e-08))
 
+    def test_rand_orthog_batch(self):
+        Q = randOrthog(6, batch=20)
+        self.assertEqual(Q.shape, (20, 6, 6))
+        self.assertTrue(np.allclose(np.matmul(Q.transpose(0, 2, 1), Q), np.eye(6)))
+        # Haar measure: E[trace(Q)] = 0 and E[trace(Q)^2] = 1
+        tr = np.trace(randOrthog(3, batch=100000), axis1=1, axis2=2)
+        self.assertTrue(abs(tr.mean()) < 0.02 and abs((tr ** 2).mean() - 1) < 0.02)
+
+    def test_rand_orthog_implicit(self):
+        lamb = np.array([2, 1, 0.75, 0.25])
+        H = randOrthog(4, batch=3, implicit=True)
+        Q = H.toarray()
+        self.assertTrue(np.allclose(np.matmul(Q.transpose(0, 2, 1), Q), np.eye(4)))
+        self.assertTrue(np.allclose(H.congruence(lamb), np.matmul(Q.transpose(0, 2, 1) * lamb, Q)))
+        A = randMatwithEigenVals(lamb, implicit=True)
+        self.assertTrue(np.allclose(LA.eigvalsh(A), np.sort(lamb)))
+
     def test_randMatwithEigen(self):
         lamb = np.array([2, 1, 0.75, 0.25])
         A = randMatwithEigenVals(lamb)
@@ -49,12 +203,16 @@ class TestRandCorr(unittest.TestCase):
         self.assertTrue(np.allclose(LA.eigvalsh(A), np.sort(lamb), rtol=1e-05, atol=1e-08))
 
     def test_givens(self):
+        np.random.seed(3)
         lamb = np.array([2, 1, 0.75, 0.25])
         Q = randMatwithEigenVals(lamb)
-        J = applyGivens(Q, 2, 3)
-        self.assertAlmostEqual(Q[0,0], J[0,0], places=16)
-        self.assertAlmostEqual(Q[1, 1], J[1, 1], places=16)
-        self.assertAlmostEqual(J[2,2], 1.0, places=14)
+        # the rotation sets Q[i, i] to 1 when Q[i, i] and Q[j, j] are on opposite sides of 1
+        i, j = np.argmin(np.diag(Q)), np.argmax(np.diag(Q))
+        k, l = sorted(set(range(4)) - {i, j})
+        J = applyGivens(Q, i, j)
+        self.assertAlmostEqual(Q[k, k], J[k, k], places=16)
+        self.assertAlmostEqual(Q[l, l], J[l, l], places=16)
+        self.assertAlmostEqual(J[i, i], 1.0, places=14)
         self.assertAlmostEqual(np.trace(J), 4.0, places=10)
 
     def test_randcorrwitheigenvalue(self):
@@ -63,6 +221,39 @@ class TestRandCorr(unittest.TestCase):
         self.assertTrue(isvalid_corr(corr_mat))
         self.assertTrue(np.allclose(LA.eigvalsh(corr_mat), np.sort(e), rtol=1e-02, atol=1e-08))
 
+    def test_randcorrwitheigenvalue_stats(self):
+        e = np.linspace(0.1, 2, 20)
+        pairs = []
+        corr_mat, stats = randCorrGivenEgienvalues(e, full_output=True,
+                                                   callback=lambda stats: pairs.append(stats.info['pair']))
+        self.assertTrue(isvalid_corr(corr_mat))
+        self.assertTrue(stats.converged)
+        self.assertEqual(stats.iterations, len(pairs))
+        self.assertLessEqual(stats.iterations, 19)
+        self.assertLessEqual(stats.residual, 1e-12)
+        self.assertEqual(set(stats.timings), {'congruence', 'givens'})
+        _, silent = randCorrGivenEgienvalues(e, full_output=True)
+        self.assertEqual(len(silent.residuals), silent.iterations)
+        self.assertGreater(silent.iterations, 0)
+        _, stopped = randCorrGivenEgienvalues(e, full_output=True, callback=lambda stats: True)
+        self.assertEqual(stopped.iterations, 1)
+        self.assertFalse(stopped.converged)
+
+    def test_givens_in_place(self):
+        A = randMatwithEigenVals(np.array([2, 1, 0.75, 0.25, 1]))
+        A = (A + A.T) / 2
+        c, s = 0.8, 0.6
+        G = np.eye(5)
+        G[1, 1] = G[3, 3] = c
+        G[1, 3], G[3, 1] = s, -s
+        self.assertTrue(np.allclose(rotateInPlace(A.copy(), 1, 3, c, s), np.dot(G.T, np.dot(A, G))))
+
+    def test_randcorrwitheigenvalue_full_precision(self):
+        e = np.linspace(0.05, 2, 200)
+        corr_mat = randCorrGivenEgienvalues(e, decimals=None)
+        self.assertTrue(isvalid_corr(corr_mat))
+        self.assertTrue(np.allclose(LA.eigvalsh(corr_mat), 200 * e / np.sum(e), atol=1e-10))
+
     # Test Nearest Corr
     def test_near_corr(self):
         A = np.array([[1, 1, 0],
@@ -78,9 +269,365 @@ class TestRandCorr(unittest.TestCase):
         # print(np.abs((X - expected_result))/1e-5)
         self.assertTrue((np.abs((X - expected_result)) < 2e-5).all())
 
+    def test_near_corr_newton(self):
+        A = np.array([[1, 1, 0],
+                      [1, 1, 1],
+                      [0, 1, 1]])
+        res = nearcorr(A, method='newton', full_output=True)
+        self.assertTrue(res.converged)
+        self.assertTrue(np.allclose(res.X, nearcorr(A, max_iterations=1000), atol=1e-8))
+        self.assertTrue(np.allclose(np.diag(res.X), 1.))
+
+    def test_near_corr_weights(self):
+        A = np.array([[1, 1, 0],
+                      [1, 1, 1],
+                      [0, 1, 1]])
+        w = np.array([1., 2., 3.])
+        X = nearcorr(A, weights=w, max_iterations=1000)
+        self.assertTrue(np.allclose(X, nearcorr(A, weights=w, method='newton'), atol=1e-8))
+
+    def test_near_corr_warm_start(self):
+        rs = np.random.RandomState(0)
+        A = rs.uniform(-1, 1, (30, 30))
+        A = np.triu(A, 1) + np.triu(A, 1).T + np.eye(30)
+        B = A + 1e-4 * (rs.rand(30, 30) - 0.5)
+        B = (B + B.T) / 2
+        for method in ('alternating', 'newton'):
+            res_a = nearcorr(A, max_iterations=1000, method=method, full_output=True)
+            cold = nearcorr(B, max_iterations=1000, method=method, full_output=True)
+            warm = nearcorr(B, max_iterations=1000, method=method, warm_start=res_a, full_output=True)
+            self.assertTrue(warm.converged)
+            self.assertTrue(warm.iterations < cold.iterations)
+            self.assertTrue(np.allclose(warm.X, cold.X, atol=1e-6))
+
+    def test_near_corr_stats(self):
+        A = np.array([[2, -1, 0, 0], [-1, 2, -1, 0], [0, -1, 2, -1], [0, 0, -1, 2]], dtype=float)
+        for method in ('alternating', 'newton'):
+            seen = []
+            res = nearcorr(A, method=method, full_output=True, callback=lambda stats: seen.append(stats.residual))
+            stats = res.stats
+            self.assertTrue(stats.converged)
+            self.assertEqual(stats.iterations, res.iterations)
+            self.assertEqual(seen, stats.residuals)
+            self.assertEqual(stats.residual, res.residual)
+            self.assertTrue(stats.wall_time >= stats.timings['eigh'] > 0)
+            self.assertIn('time_matmul', stats.as_dict())
+        res = nearcorr(A, full_output=True, callback=lambda stats: stats.iterations == 3)
+        self.assertEqual(res.iterations, 3)
+        self.assertFalse(res.converged or res.stats.converged)
+
+    def test_near_corr_sequence(self):
+        rs = np.random.RandomState(0)
+        R = rs.randn(40, 12)
+        As = np.array([np.corrcoef(R[t:t + 8].T) for t in range(30)])
+        As += 0.05 * np.sign(As) * (1 - np.eye(12))
+        cold = nearcorr_sequence(As, warm=False, full_output=True, method='newton')
+        warm = nearcorr_sequence(As, full_output=True, method='newton')
+        parallel = nearcorr_sequence(As, n_jobs=2, method='newton')
+        self.assertTrue(warm.converged.all())
+        self.assertLess(warm.total_iterations, cold.total_iterations)
+        self.assertTrue(np.allclose(warm.X, cold.X, atol=1e-6))
+        self.assertTrue(np.allclose(parallel, warm.X, atol=1e-6))
+        self.assertTrue(np.allclose(warm.X[5], nearcorr(As[5], method='newton'), atol=1e-6))
+        self.assertGreater(warm.matrices_per_second, 0)
+
+    def test_proj_spd_partial(self):
+        rs = np.random.RandomState(0)
+        d, v = LA.eigh(np.corrcoef(rs.randn(200, 600)))
+        d[:3] = [-0.05, -0.02, -0.01]
+        A = (v * d).dot(v.T)
+        A = (A + A.T) / 2
+        P = proj_spd(A, method='partial')
+        self.assertTrue(np.allclose(P, proj_spd(A), atol=1e-10))
+        self.assertTrue(LA.eigvalsh(P).min() > -1e-12)
+        # too many negative eigenvalues for Lanczos, falls back to eigh
+        B = np.triu(rs.uniform(-1, 1, (200, 200)), 1)
+        B = B + B.T + np.eye(200)
+        self.assertTrue(np.allclose(proj_spd(B, method='partial'), proj_spd(B), atol=1e-10))
+
+    def test_near_corr_projection(self):
+        rs = np.random.RandomState(1)
+        A = np.triu(rs.uniform(-1, 1, (40, 40)), 1)
+        A = A + A.T + np.eye(40)
+        X = nearcorr(A, max_iterations=500, projection='full')
+        for projection in ('partial', 'auto'):
+            self.assertTrue(np.allclose(nearcorr(A, max_iterations=500, projection=projection), X, atol=1e-8))
+
     # Perturb Correlation Matrix
     def test_perturb_corr(self):
         corr_mat = np.array([[1, 0.5, 0.75],[0.5, 1, 0.75], [0.75, 0.75, 1]])
         new_corr = perturb_randCorr(corr_mat)
         obj = isvalid_corr(new_corr)
-        self.assertTrue(obj)
\ No newline at end of file
+        self.assertTrue(obj)
+
+    def test_perturb_corr_batch(self):
+        corr_mat = randCorrOnion(8)
+        perturber = CorrPerturber(corr_mat)
+        perturbed = perturber.sample(20)
+        self.assertEqual(perturbed.shape, (20, 8, 8))
+        self.assertTrue(validate_corr(perturbed)[0].all())
+        self.assertEqual(perturb_randCorr(corr_mat, num=3).shape, (3, 8, 8))
+
+    def test_min_eigenvalue(self):
+        corr_mat = randCorrOnion(600)
+        expected = np.linalg.eigvalsh(corr_mat)[0]
+        for method in ('full', 'shift-invert', 'auto'):
+            self.assertAlmostEqual(min_eigenvalue(corr_mat, method) / expected, 1., places=6)
+        not_pd = np.array([[1, 0.9, -0.9], [0.9, 1, 0.9], [-0.9, 0.9, 1]])
+        self.assertAlmostEqual(min_eigenvalue(not_pd, 'shift-invert'), np.linalg.eigvalsh(not_pd)[0])
+
+    # Correlated samples
+    def test_sampler(self):
+        np.random.seed(1)
+        C = randCorrOnion(5)
+        chunks = list(CorrelatedSampler(C, chunk_size=30000).chunks(100000))
+        self.assertEqual([len(x) for x in chunks], [30000, 30000, 30000, 10000])
+        self.assertTrue(np.allclose(np.corrcoef(np.concatenate(chunks).T), C, atol=0.02))
+        u = CorrelatedSampler(C).sample(1000, kind='uniform')
+        self.assertTrue(u.min() >= 0 and u.max() <= 1)
+        # only PSD: the rank 2 correlation matrix of two perfectly correlated pairs
+        x = CorrelatedSampler(np.kron(np.eye(2), np.ones((2, 2)))).sample(10)
+        self.assertTrue(np.allclose(x[:, 0], x[:, 1]) and np.allclose(x[:, 2], x[:, 3]))
+        self.assertRaises(ValueError, CorrelatedSampler, np.array([[1, 2], [2, 1.]]))
+
+    def test_sampler_factors(self):
+        np.random.seed(2)
+        L = randCorrOnionCholesky(4, batch=2)
+        x = CorrelatedSampler.from_cholesky(L).sample(100000)
+        self.assertEqual(x.shape, (2, 100000, 4))
+        self.assertTrue(np.allclose(np.corrcoef(x[1].T), np.dot(L[1], L[1].T), atol=0.02))
+        A, T = randMatwithEigenVals(np.array([2, 1, 0.75, 0.25]), return_factor=True)
+        self.assertTrue(np.allclose(np.dot(T, T.T), A))
+        self.assertTrue(np.allclose(np.cov(CorrelatedSampler.from_factor(T).sample(100000).T), A, atol=0.05))
+        F = randCorrFactor(6, 2, structured=True)
+        self.assertTrue(np.allclose(np.corrcoef(CorrelatedSampler(F).sample(100000).T), F.toarray(), atol=0.02))
+
+    # Factorization cache
+    def test_factor_cache(self):
+        corr_mat = randCorrOnion(20)
+        cache = enable_cache()
+        try:
+            self.assertTrue(isPD(corr_mat))
+            self.assertTrue(isvalid_corr(corr_mat.copy()))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            lamb = CorrPerturber(corr_mat, method='shift-invert').min_eigenvalue
+            self.assertEqual(cache.hits, 2)
+            self.assertAlmostEqual(lamb, np.linalg.eigvalsh(corr_mat)[0])
+            X = nearcorr(corr_mat, method='newton')
+            nearcorr(corr_mat)
+            self.assertEqual(cache.hits, 3)
+            self.assertTrue(np.allclose(X, corr_mat))
+            entries = len(cache)
+            self.assertTrue(validate_corr(np.array([randCorrOnion(20) for _ in range(5)]))[0].all())
+            self.assertEqual(len(cache), entries)
+            # only the cold, unweighted first solve decomposes a matrix of the caller
+            As = np.array([corr_mat + 0.01 * k * (1 - np.eye(20)) for k in range(1, 6)])
+            nearcorr_sequence(As, method='newton')
+            nearcorr(As[0], weights=np.linspace(1, 2, 20))
+            self.assertEqual(len(cache), entries + 1)
+            L, info = cache.cholesky(corr_mat)
+            self.assertEqual(info, 0)
+            self.assertFalse(L.flags.writeable)
+        finally:
+            disable_cache()
+        self.assertIsNone(get_cache())
+
+    def test_factor_cache_eviction(self):
+        cache = FactorCache(max_bytes=3 * 10 * 10 * 8)
+        mats = [randCorrOnion(10) for _ in range(4)]
+        for corr_mat in mats:
+            cache.cholesky(corr_mat)
+        self.assertEqual((len(cache), cache.evictions, cache.misses), (3, 1, 4))
+        cache.cholesky(mats[3])
+        cache.cholesky(mats[0])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 5, 2))
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+    # Ensembles
+    def test_ensemble_chunks(self):
+        chunks = list(ensemble_chunks('randCorr', 25, chunk_size=10, seed=7, size=6))
+        self.assertEqual([c.shape for c in chunks], [(10, 6, 6), (10, 6, 6), (5, 6, 6)])
+        self.assertTrue(all(isvalid_corr(c) for chunk in chunks for c in chunk))
+        self.assertRaises(ValueError, ensemble_chunks, 'randCorr', 25, chunk_size=0, size=6)
+
+    def test_ensemble_chunks_reproducible(self):
+        serial = list(ensemble_chunks(randCorrOnion, 30, chunk_size=7, seed=11, size=5))
+        parallel = list(ensemble_chunks(randCorrOnion, 30, chunk_size=7, seed=11, n_jobs=2, max_in_flight=2, size=5))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(serial, parallel)))
+        other = next(ensemble_chunks(randCorrOnion, 30, chunk_size=7, seed=12, size=5))
+        self.assertFalse(np.array_equal(serial[0], other))
+
+    def test_ensemble_store(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'onion.npy')
+            store = write_ensemble(path, 'randCorrOnion', 25, chunk_size=10, seed=3, size=6)
+            expected = np.concatenate(list(ensemble_chunks('randCorrOnion', 25, chunk_size=10, seed=3, size=6)))
+            self.assertEqual((len(store), store.n, store.packed.shape), (25, 6, (25, 15)))
+            self.assertTrue(store.complete)
+            self.assertTrue(np.allclose(store[:], expected))
+            self.assertTrue(np.array_equal(store[7], expected[7]))
+            self.assertTrue(np.shares_memory(store.packed[3:5], store.packed))
+            self.assertEqual(read_metadata(path)['chunks'][2]['count'], 5)
+
+            # interrupted after the first chunk
+            meta = read_metadata(path)
+            meta['chunks'], meta['num_written'] = meta['chunks'][:1], 10
+            with open(path + '.json', 'w') as f:
+                json.dump(meta, f)
+            del store
+            self.assertEqual(len(EnsembleStore(path)), 10)
+            resumed = write_ensemble(path, 'randCorrOnion', 25, chunk_size=10, size=6)
+            self.assertTrue(np.array_equal(resumed[:], expected))
+            self.assertRaises(ValueError, write_ensemble, path, 'randCorrOnion', 25, chunk_size=10, size=7)
+
+            single = write_ensemble(os.path.join(tmpdir, 'single.npy'), randCorr, 4, dtype=np.float32, size=5)
+            self.assertEqual(single.packed.dtype, np.float32)
+            self.assertTrue(np.allclose(pack(single[:]), single.packed))
+            empty = os.path.join(tmpdir, 'empty.npy')
+            self.assertRaises(ValueError, write_ensemble, empty, 'randCorrOnion', 0, size=5)
+            self.assertFalse(os.path.exists(empty))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # Random streams
+    def test_rng_reproducible(self):
+        lamb = np.r_[2, 1, 0.75, 0.25]
+        C = randCorrOnion(5)
+        F = randCorrFactor(5, 2, structured=True)
+        draws = [lambda rng: randCorr(5, batch=2, rng=rng), lambda rng: randCorrOnion(5, batch=2, rng=rng),
+                 lambda rng: randCorrFactor(5, 2, batch=2, rng=rng), lambda rng: randOrthog(4, batch=2, rng=rng),
+                 lambda rng: randCorrGivenEgienvalues(lamb, rng=rng), lambda rng: perturb_randCorr(C, 2, rng=rng),
+                 lambda rng: F.sample(3, rng=rng),
+                 lambda rng: CorrelatedSampler(C, rng=rng).sample(3)]
+        for draw in draws:
+            self.assertTrue(np.array_equal(draw(5), draw(np.random.default_rng(5))))
+            self.assertFalse(np.array_equal(draw(5), draw(6)))
+        self.assertTrue(all(isvalid_corr(c) for c in randCorrOnion(5, batch=3, rng=np.random.RandomState(1))))
+
+    def test_rng_global_state(self):
+        np.random.seed(4)
+        a = randCorrOnion(5)
+        np.random.seed(4)
+        self.assertTrue(np.array_equal(a, randCorrOnion(5, rng=None)))
+        state = np.random.get_state()[1].copy()
+        list(ensemble_chunks('randCorrOnion', 4, chunk_size=2, seed=1, size=5))
+        self.assertTrue(np.array_equal(state, np.random.get_state()[1]))
+
+    def test_spawn_rngs(self):
+        first = [rng.standard_normal(3) for rng in spawn_rngs(9, 4)]
+        second = [rng.standard_normal(3) for rng in spawn_rngs(np.random.SeedSequence(9), 4)]
+        self.assertTrue(np.array_equal(first, second))
+        self.assertEqual(len({tuple(x) for x in first}), 4)
+        self.assertEqual(len(spawn_rngs(9, 2, bit_generator='Philox')), 2)
+        self.assertTrue(np.array_equal(as_seed_seq(np.random.default_rng(3)).entropy,
+                                       as_seed_seq(np.random.default_rng(3)).entropy))
+
+    # Thread budget
+    def test_thread_budget_plan(self):
+        budget = ThreadBudget(cpus=8, blas_min_size=256, pool_min_flops=1e6)
+        self.assertEqual(budget.plan(50, 1000), (8, 1))
+        self.assertEqual(budget.plan(1000, 100), (2, 4))
+        self.assertEqual(budget.plan(5000, 100), (1, 8))
+        self.assertEqual(budget.plan(1000, 1), (1, 8))
+        self.assertEqual(budget.plan(10, 10), (1, 8))
+        self.assertEqual(budget.plan(1000, 100, n_jobs=4), (4, 2))
+        self.assertEqual(budget.plan(100, 3), (3, 2))
+        self.assertEqual(budget.plan(10, 10, flops_per_task=1e5), (8, 1))
+        self.assertEqual(budget.plan(10, 10, batch=1000), budget.plan(10, 10, flops_per_task=1e6))
+
+    def test_thread_budget_context(self):
+        previous = get_thread_budget()
+        with thread_budget(cpus=2, blas_min_size=10) as budget:
+            self.assertIs(get_thread_budget(), budget)
+            self.assertEqual(budget.cpus, 2)
+            serial = list(ensemble_chunks(randCorrOnion, 12, chunk_size=3, seed=5, size=20))
+            auto = list(ensemble_chunks(randCorrOnion, 12, chunk_size=3, seed=5, n_jobs='auto', size=20))
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(serial, auto)))
+        self.assertIs(get_thread_budget(), previous)
+
+    # Online estimates
+    def test_online_corr(self):
+        X = np.random.randn(200, 8)
+        est = OnlineCorrEstimator(8)
+        est.update(X[:50])
+        for x in X[50:]:
+            est.update(x)
+        self.assertTrue(np.allclose(est.covariance(), np.cov(X.T)))
+        self.assertTrue(np.allclose(est.correlation(), np.corrcoef(X.T)))
+        self.assertEqual((est.num_eigen_refreshes, est.num_repairs), (1, 0))
+        est.update(X[0])
+        est.correlation()
+        self.assertEqual(est.num_eigen_refreshes, 1)
+        self.assertGreater(est.min_eigenvalue, 0)
+
+    def test_online_corr_weighted(self):
+        X = np.random.randn(30, 6)
+        est = OnlineCorrEstimator(6, halflife=10)
+        est.update(X)
+        w = 0.5 ** 0.1
+        mean, cov = X[0], np.zeros((6, 6))
+        for x in X[1:]:
+            d = x - mean
+            mean = mean + (1 - w) * d
+            cov = w * (cov + (1 - w) * np.outer(d, d))
+        self.assertTrue(np.allclose(est.mean, mean))
+        self.assertTrue(np.allclose(est.covariance(), cov))
+
+    def test_online_corr_repair(self):
+        est = OnlineCorrEstimator(10)
+        est.update(np.random.randn(4, 10))
+        C = est.correlation()
+        self.assertTrue(isvalid_corr(C, tol=1e-6))
+        self.assertTrue(isPD(C))
+        self.assertGreaterEqual(min_eigenvalue(C), 0.9e-10)
+        self.assertEqual(est.num_repairs, 1)
+        self.assertTrue(np.array_equal(est.correlation(), C))
+        self.assertEqual(est.num_repairs, 1)
+        self.assertLess(min_eigenvalue(est.correlation(repair=False)), 1e-10)
+        est.update(np.random.randn(10))
+        est.correlation()
+        self.assertEqual(est.num_repairs, 2)
+        self.assertRaises(ValueError, OnlineCorrEstimator(3).correlation)
+
+    def test_online_corr_constant(self):
+        X = np.random.randn(80, 6)
+        X[:, 2] = 1.
+        est = OnlineCorrEstimator(6)
+        for x in X:
+            est.update(x)
+            if est.count > 1:
+                C = est.correlation()
+        self.assertTrue(isPD(C))
+        self.assertTrue(np.array_equal(C[2], np.eye(6)[2]))
+        self.assertLess(est.num_eigen_refreshes, 20)
+        self.assertGreater(est.min_eigenvalue, 1e-10)
+
+    # Sparse matrices
+    def test_random_corr_sparse(self):
+        for kwargs in [{'bandwidth': 3}, {'nnz_per_row': 4}, {'bandwidth': 3, 'method': 'dominant'},
+                       {'nnz_per_row': 6, 'method': 'dominant', 'strength': 0.5}]:
+            C = randCorrSparse(200, rng=1, **kwargs)
+            self.assertTrue(scipy.sparse.isspmatrix_csr(C))
+            self.assertTrue(isvalid_corr(C))
+            self.assertTrue(isvalid_corr(C.toarray()))
+            self.assertAlmostEqual(min_eigenvalue(C), np.linalg.eigvalsh(C.toarray())[0])
+        C = randCorrSparse(1000, bandwidth=2, rng=2)
+        self.assertTrue(np.all(np.abs(C.tocoo().row - C.tocoo().col) <= 2))
+        self.assertGreaterEqual(min_eigenvalue(randCorrSparse(1000, method='dominant', strength=0.6, rng=3)), 0.4)
+        self.assertRaises(ValueError, randCorrSparse, 10, method='dominant', strength=1.)
+
+    def test_isvalid_corr_sparse(self):
+        C = randCorrSparse(600, bandwidth=4, rng=4).tolil()
+        C[0, 5] = 0.5
+        self.assertEqual(isvalid_corr(C).cause, ['Not symmetric'])
+        C = scipy.sparse.csr_matrix(constantCorrMat(600, 0.5))
+        C[0, 0] = 1.2
+        self.assertEqual(isvalid_corr(C).cause, ['Off Diagonal outside [-1, 1]', 'Diagonal != 1'])
+        C = scipy.sparse.diags([-0.45, 1., -0.45], [-1, 0, 1], shape=(600, 600), format='csr')
+        self.assertTrue(isvalid_corr(C))
+        self.assertTrue(isPD(C))
+        C = scipy.sparse.diags([0.9, 1., 0.9], [-1, 0, 1], shape=(600, 600), format='csr')
+        self.assertFalse(isvalid_corr(C))
+        self.assertEqual(isvalid_corr(C).cause, ['Not Positive Definite'])
+        self.assertLess(min_eigenvalue(C), 0)
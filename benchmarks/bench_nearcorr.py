@@ -0,0 +1,85 @@
+# ---------------------------------------------------------------------------------
+# Alternating projections against the Newton method in nearcorr
+#
+#   python benchmarks/bench_nearcorr.py [sizes...]
+# ---------------------------------------------------------------------------------
+import sys
+import time
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from RandomCorrMat import nearcorr
+
+
+def higham_example():
+    return np.array([[1, 1, 0],
+                     [1, 1, 1],
+                     [0, 1, 1]], dtype=float)
+
+
+def random_unit_diagonal(n, seed=0):
+    """
+    Symmetric matrix with unit diagonal and off-diagonal entries uniform in [-1, 1], far from PSD.
+    """
+    rs = np.random.RandomState(seed)
+    A = np.triu(rs.uniform(-1, 1, (n, n)), 1)
+    return A + A.T + np.eye(n)
+
+
+def noisy_estimate(n, seed=0, noise=0.1):
+    """
+    Sample correlation matrix of n series over n/2 observations plus symmetric noise.
+    """
+    rs = np.random.RandomState(seed)
+    C = np.corrcoef(rs.randn(n, max(n // 2, 2)))
+    E = np.triu(rs.normal(scale=noise, size=(n, n)), 1)
+    return C + E + E.T
+
+
+def nearly_psd(n, seed=0, num_negative=8):
+    """
+    Well conditioned sample correlation matrix with its num_negative smallest eigenvalues made slightly negative.
+    """
+    rs = np.random.RandomState(seed)
+    d, v = np.linalg.eigh(np.corrcoef(rs.randn(n, 10 * n)))
+    d[:num_negative] = -np.linspace(0.01, 0.05, num_negative)
+    A = (v * d).dot(v.T)
+    A = (A + A.T) / 2
+    A[np.diag_indices(n)] = 1
+    return A
+
+
+def run_projections(name, A, max_iterations):
+    for projection in ('full', 'partial', 'auto'):
+        start = time.perf_counter()
+        res = nearcorr(A, max_iterations=max_iterations, projection=projection, full_output=True)
+        print('%-22s %-12s %6d %12.3e %10s %10.4f' % (name, 'proj=' + projection, res.iterations, res.residual,
+                                                      res.converged, time.perf_counter() - start))
+
+
+def run(name, A, max_iterations):
+    rows = []
+    for method in ('alternating', 'newton'):
+        start = time.perf_counter()
+        res = nearcorr(A, max_iterations=max_iterations, method=method, full_output=True)
+        rows.append((method, res, time.perf_counter() - start))
+    diff = np.abs(rows[0][1].X - rows[1][1].X).max()
+    for method, res, elapsed in rows:
+        print('%-22s %-12s %6d %12.3e %10s %10.4f' % (name, method, res.iterations, res.residual, res.converged,
+                                                      elapsed))
+    print('%-22s max |X_alternating - X_newton| = %.2e' % (name, diff))
+
+
+def main(sizes=(100, 500, 1000), max_iterations=100):
+    print('%-22s %-12s %6s %12s %10s %10s' % ('input', 'method', 'iters', 'residual', 'converged', 'time (s)'))
+    run('higham 3x3', higham_example(), max_iterations)
+    for n in sizes:
+        run('uniform n=%d' % n, random_unit_diagonal(n), max_iterations)
+        run('noisy n=%d' % n, noisy_estimate(n), max_iterations)
+        run_projections('nearly psd n=%d' % n, nearly_psd(n), max_iterations)
+
+
+if __name__ == '__main__':
+    main(tuple(int(s) for s in sys.argv[1:]) or (100, 500, 1000))
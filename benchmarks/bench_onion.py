@@ -0,0 +1,67 @@
+# ---------------------------------------------------------------------------------
+# Scaling of the Cholesky based onion sampler against the original sqrtm recursion
+#
+#   python benchmarks/bench_onion.py
+# ---------------------------------------------------------------------------------
+import sys
+import timeit
+from os import path
+
+import numpy as np
+import scipy.linalg
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from RandomCorrMat import randCorrOnion
+
+
+def randCorrOnionSqrtm(size):
+    """
+    The original implementation of randCorrOnion: a full matrix square root of the growing matrix at every step.
+    """
+    S = [[1]]
+    for i in range(1, size):
+        k = i + 1
+        if k == size:
+            y = np.random.uniform(0, 1)
+        else:
+            y = np.random.beta((k-1)/2, (size-k)/2)
+        r = np.sqrt(y)
+        theta = np.random.randn(k-1, 1)
+        theta = theta / np.sqrt(np.dot(theta.T, theta))
+        w = r * theta
+        R = scipy.linalg.sqrtm(S)
+        q = np.dot(R, w)
+        S = np.vstack((np.hstack((S, q)),np.hstack((q.T, [[1]]))))
+    return S
+
+
+def best_time(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def scaling_exponent(sizes, times):
+    return np.polyfit(np.log(sizes), np.log(times), 1)[0]
+
+
+def main(sizes=(10, 25, 50, 100, 200), large_sizes=(500, 1000), batch=1000, batch_size=10):
+    print('%8s %14s %14s %10s' % ('size', 'sqrtm (s)', 'cholesky (s)', 'speedup'))
+    old, new = [], []
+    for n in sizes:
+        t_old = best_time(lambda: randCorrOnionSqrtm(n), repeat=1 if n > 100 else 3)
+        t_new = best_time(lambda: randCorrOnion(n))
+        old.append(t_old)
+        new.append(t_new)
+        print('%8d %14.5f %14.5f %9.1fx' % (n, t_old, t_new, t_old / t_new))
+    for n in large_sizes:
+        t_new = best_time(lambda: randCorrOnion(n))
+        print('%8d %14s %14.5f' % (n, '-', t_new))
+    print('scaling exponent: sqrtm %.2f, cholesky %.2f' % (scaling_exponent(sizes, old), scaling_exponent(sizes, new)))
+
+    t_loop = best_time(lambda: [randCorrOnion(batch_size) for _ in range(batch)])
+    t_batch = best_time(lambda: randCorrOnion(batch_size, batch=batch))
+    print('%d matrices of size %d: loop %.4fs, batch %.4fs (%.1fx)' % (batch, batch_size, t_loop, t_batch,
+                                                                      t_loop / t_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# ---------------------------------------------------------------------------------
+# QR based Haar sampler against the Stewart loop in randOrthog
+#
+#   python benchmarks/bench_orthog.py
+# ---------------------------------------------------------------------------------
+import sys
+import timeit
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from RandomCorrMat.RandomCorrMatEigen import randOrthog, randMatwithEigenVals
+
+
+def randOrthogStewart(n, f=np.random.randn):
+    """
+    The original implementation of randOrthog: n Householder updates of A[k:, :] in a Python loop.
+    """
+    A = np.eye(n)
+    d = np.zeros((n, 1))
+    d[n-1, 0] = np.sign(f())
+    for k in range(n-2, -1, -1):
+        x = f(n-k, 1)
+        s = np.sqrt(np.dot(x[:, 0], x[:, 0]))
+        sg = np.sign(x[0, 0])
+        s = sg*s
+        d[k, 0] = -sg
+        x[0, 0] = x[0, 0] + s
+        beta = s * x[0, 0]
+        y = np.dot(x.T, A[k:, :])
+        A[k:, :] = A[k:, :] - x*(y/beta)
+    return d*A
+
+
+def best_time(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(sizes=(50, 200, 500, 1000), batch=10000, batch_size=10):
+    print('%8s %12s %12s %10s %16s %16s' % ('size', 'stewart (s)', 'qr (s)', 'speedup', 'eigen dense (s)',
+                                            'eigen implicit (s)'))
+    for n in sizes:
+        t_old = best_time(lambda: randOrthogStewart(n))
+        t_new = best_time(lambda: randOrthog(n))
+        lamb = np.linspace(0.1, 2, n)
+        t_dense = best_time(lambda: randMatwithEigenVals(lamb))
+        t_implicit = best_time(lambda: randMatwithEigenVals(lamb, implicit=True))
+        print('%8d %12.5f %12.5f %9.1fx %16.5f %16.5f' % (n, t_old, t_new, t_old / t_new, t_dense, t_implicit))
+
+    t_loop = best_time(lambda: [randOrthogStewart(batch_size) for _ in range(batch)], repeat=1)
+    t_batch = best_time(lambda: randOrthog(batch_size, batch=batch))
+    print('%d matrices of size %d: stewart loop %.4fs, batched qr %.4fs (%.1fx)' % (batch, batch_size, t_loop,
+                                                                                   t_batch, t_loop / t_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# ---------------------------------------------------------------------------------
+# Time, peak memory and iteration counts of every public entry point, swept over matrix size and batch size,
+# with scaling exponents and a regression check against a stored baseline
+#
+#   python benchmarks/bench_suite.py --save baseline.json          # record a baseline
+#   python benchmarks/bench_suite.py --baseline baseline.json      # compare, exit status 1 on a regression
+#   python benchmarks/bench_suite.py --quick --only nearcorr       # smaller sweep, cases matching a substring
+#
+# Runs offline on the CPU. Peak memory is that of the numpy allocations traced by tracemalloc, the LAPACK
+# workspaces are not included. Pin the BLAS threads (e.g. OMP_NUM_THREADS=1) to compare runs across machines.
+# ---------------------------------------------------------------------------------
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import RandomCorrMat
+from RandomCorrMat import *
+from bench_nearcorr import noisy_estimate
+
+CASES = OrderedDict()
+
+
+def case(name, sizes, batches=(), batch_size=10, iterations=False):
+    """
+    Register a benchmark: setup(n, batch) builds the inputs and returns a function running the entry point once,
+    which returns the iteration count when iterations is True. The size sweep is run with batch=1, the batch sweep
+    with n=batch_size.
+    """
+    def register(setup):
+        CASES[name] = dict(setup=setup, sizes=sizes, batches=batches, batch_size=batch_size, iterations=iterations)
+        return setup
+    return register
+
+
+def onion(n, batch=None, seed=0):
+    np.random.seed(seed)
+    return randCorrOnion(n, batch=batch)
+
+
+def spectrum(n):
+    e = np.linspace(0.1, 1, n)
+    return e * n / e.sum()
+
+
+# ----------------------------------------- generators -----------------------------------------
+
+@case('randCorr', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorr(n, batch):
+    return lambda: randCorr(n, batch=None if batch == 1 else batch)
+
+@case('randCorrOnion', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorrOnion(n, batch):
+    return lambda: randCorrOnion(n, batch=None if batch == 1 else batch)
+
+@case('randCorrOnionCholesky', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorrOnionCholesky(n, batch):
+    return lambda: randCorrOnionCholesky(n, batch=None if batch == 1 else batch)
+
+@case('randCorrLKJ', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorrLKJ(n, batch):
+    return lambda: randCorrLKJ(n, eta=2., batch=None if batch == 1 else batch)
+
+@case('randCorrLKJ cholesky', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorrLKJ_cholesky(n, batch):
+    return lambda: randCorrLKJ(n, eta=2., batch=None if batch == 1 else batch, cholesky=True)
+
+@case('randCorrFactor', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_randCorrFactor(n, batch):
+    return lambda: randCorrFactor(n, max(1, n // 10), batch=None if batch == 1 else batch)
+
+@case('randCorrGivenEgienvalues', sizes=(10, 50, 100, 200, 400))
+def bench_randCorrGivenEgienvalues(n, batch):
+    e = spectrum(n)
+    return lambda: randCorrGivenEgienvalues(e)
+
+@case('constantCorrMat', sizes=(10, 100, 1000))
+def bench_constantCorrMat(n, batch):
+    return lambda: constantCorrMat(n, 0.5)
+
+@case('perturb_randCorr', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000))
+def bench_perturb_randCorr(n, batch):
+    C = onion(n)
+    return lambda: perturb_randCorr(C, num=None if batch == 1 else batch)
+
+@case('CorrPerturber.sample', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000))
+def bench_CorrPerturber(n, batch):
+    perturber = CorrPerturber(onion(n))
+    return lambda: perturber.sample(None if batch == 1 else batch)
+
+@case('ensemble_chunks', sizes=(10, 50, 100), batches=(100, 1000, 10000))
+def bench_ensemble_chunks(n, batch):
+    def run():
+        for _ in ensemble_chunks('randCorrOnion', batch, chunk_size=1000, seed=0, size=n):
+            pass
+    return run
+
+@case('write_ensemble', sizes=(10, 50, 100), batches=(100, 1000, 10000))
+def bench_write_ensemble(n, batch):
+    def run():
+        tmpdir = tempfile.mkdtemp()
+        try:
+            write_ensemble(path.join(tmpdir, 'bench.npy'), 'randCorrOnion', batch, chunk_size=1000, seed=0, size=n)
+        finally:
+            shutil.rmtree(tmpdir)
+    return run
+
+@case('unpack', sizes=(10, 50, 100, 200), batches=(1, 100, 1000, 10000))
+def bench_unpack(n, batch):
+    P = pack(onion(n, batch=batch))
+    return lambda: unpack(P)
+
+@case('randCorrBlock', sizes=(100, 1000, 5000, 20000))
+def bench_randCorrBlock(n, batch):
+    # blocks of 100 assets
+    return lambda: randCorrBlock([100] * (n // 100), structured=True, seed=0)
+
+@case('randCorrSparse', sizes=(1000, 10000, 100000))
+def bench_randCorrSparse(n, batch):
+    return lambda: randCorrSparse(n, bandwidth=5, rng=0)
+
+@case('isvalid_corr sparse', sizes=(1000, 10000, 100000))
+def bench_isvalid_corr_sparse(n, batch):
+    C = randCorrSparse(n, bandwidth=5, rng=0)
+    return lambda: isvalid_corr(C)
+
+@case('BlockCorr.solve', sizes=(100, 1000, 5000, 20000))
+def bench_BlockCorr_solve(n, batch):
+    C = randCorrBlock([100] * (n // 100), structured=True, seed=0)
+    b = np.ones(n)
+    return lambda: C.solve(b)
+
+@case('FactorCorr.solve', sizes=(100, 1000, 10000, 50000))
+def bench_FactorCorr_solve(n, batch):
+    np.random.seed(0)
+    F = randCorrFactor(n, 10, structured=True)
+    b = np.ones(n)
+    return lambda: F.solve(b)
+
+@case('CorrelatedSampler', sizes=(10, 50, 100, 200), batches=(100, 1000, 10000, 100000), batch_size=50)
+def bench_CorrelatedSampler(n, batch):
+    sampler = CorrelatedSampler(onion(n), chunk_size=10000)
+    def run():
+        for _ in sampler.chunks(batch):
+            pass
+    return run
+
+# ----------------------------------------- repairs -----------------------------------------
+
+@case('nearcorr', sizes=(20, 50, 100, 200, 400), iterations=True)
+def bench_nearcorr(n, batch):
+    A = noisy_estimate(n)
+    return lambda: nearcorr(A, full_output=True).iterations
+
+@case('nearcorr newton', sizes=(20, 50, 100, 200, 400), iterations=True)
+def bench_nearcorr_newton(n, batch):
+    A = noisy_estimate(n)
+    return lambda: nearcorr(A, method='newton', full_output=True).iterations
+
+@case('nearcorr_sequence', sizes=(20, 50, 100), batches=(10, 50, 200), batch_size=20, iterations=True)
+def bench_nearcorr_sequence(n, batch):
+    rs = np.random.RandomState(0)
+    R = rs.randn(batch + n, n)
+    As = np.array([np.corrcoef(R[t:t + n].T) for t in range(batch)])
+    As += 0.05 * np.sign(As) * (1 - np.eye(n))
+    return lambda: nearcorr_sequence(As, method='newton', full_output=True).total_iterations
+
+@case('OnlineCorrEstimator tick', sizes=(20, 50, 100, 200, 500))
+def bench_OnlineCorrEstimator(n, batch):
+    X = np.random.RandomState(0).randn(2 * n + 10, n)
+    est = OnlineCorrEstimator(n, halflife=4 * n)
+    est.update(X[:2 * n])
+    ticks = itertools.cycle(X[2 * n:])
+
+    def run():
+        est.update(next(ticks))
+        return est.correlation()
+    return run
+
+# ----------------------------------------- diagnostics -----------------------------------------
+
+@case('isvalid_corr', sizes=(10, 50, 100, 200, 500, 1000))
+def bench_isvalid_corr(n, batch):
+    C = onion(n)
+    return lambda: isvalid_corr(C)
+
+@case('isPD', sizes=(10, 50, 100, 200, 500, 1000))
+def bench_isPD(n, batch):
+    C = onion(n)
+    return lambda: isPD(C)
+
+@case('validate_corr', sizes=(10, 50, 100, 200, 500), batches=(1, 100, 1000, 10000))
+def bench_validate_corr(n, batch):
+    C = onion(n, batch=batch)
+    return lambda: validate_corr(C)
+
+@case('min_eigenvalue', sizes=(10, 100, 500, 1000))
+def bench_min_eigenvalue(n, batch):
+    C = onion(n)
+    return lambda: min_eigenvalue(C)
+
+@case('OffDiagonalStats.update', sizes=(10, 50, 100), batches=(1, 100, 1000, 10000))
+def bench_OffDiagonalStats(n, batch):
+    C = onion(n, batch=batch)
+    return lambda: OffDiagonalStats().update(C)
+
+@case('FactorCache hit', sizes=(100, 500, 1000))
+def bench_FactorCache(n, batch):
+    C = onion(n)
+    cache = FactorCache()
+    cache.eigh(C)
+    return lambda: cache.eigh(C)
+
+
+# ----------------------------------------- measurements -----------------------------------------
+
+def measure(run, iterations=False, min_time=0.2, max_repeat=20):
+    """
+    Best time of repeated calls (at least 3, more until min_time seconds are spent), then the peak memory and the
+    iteration count (if iterations) of one more traced call.
+    """
+    times = []
+    while len(times) < 3 or (sum(times) < min_time and len(times) < max_repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        res = run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'peak_bytes': peak, 'iterations': int(res) if iterations else None}
+
+
+def scaling_exponent(xs, times):
+    """
+    Slope of log(time) against log(x), over the points above the timer resolution.
+    """
+    xs, times = np.asarray(xs, dtype=float), np.asarray(times)
+    keep = times > 1e-5
+    if keep.sum() < 2:
+        return None
+    return float(np.polyfit(np.log(xs[keep]), np.log(times[keep]), 1)[0])
+
+
+def run_suite(only=None, quick=False, min_time=0.2):
+    results = OrderedDict()
+    exponents = OrderedDict()
+    print('%-28s %6s %7s %12s %12s %6s' % ('case', 'n', 'batch', 'time (s)', 'peak (MB)', 'iters'))
+    for name, spec in CASES.items():
+        if only and not any(o in name for o in only):
+            continue
+        sweeps = [('size', [(n, 1) for n in (spec['sizes'][:2] if quick else spec['sizes'])])]
+        if spec['batches']:
+            batches = spec['batches'][:2] if quick else spec['batches']
+            sweeps.append(('batch', [(spec['batch_size'], b) for b in batches]))
+        for sweep, points in sweeps:
+            times = []
+            for n, batch in points:
+                res = measure(spec['setup'](n, batch), spec['iterations'], min_time=min_time)
+                results['%s n=%d batch=%d' % (name, n, batch)] = res
+                times.append(res['time'])
+                print('%-28s %6d %7d %12.6f %12.3f %6s' % (name, n, batch, res['time'], res['peak_bytes'] / 2. ** 20,
+                                                           '' if res['iterations'] is None else res['iterations']))
+            xs = [n for n, _ in points] if sweep == 'size' else [b for _, b in points]
+            exponents['%s %s' % (name, sweep)] = scaling_exponent(xs, times)
+
+    print('\n%-40s %8s' % ('scaling exponent', 'slope'))
+    for key, slope in exponents.items():
+        print('%-40s %8s' % (key, '-' if slope is None else '%.2f' % slope))
+    return results, exponents
+
+
+def compare(results, baseline, threshold, min_time):
+    """
+    Cases of results more than threshold (relative) slower, more memory hungry or needing more iterations than in
+    baseline. Times below min_time are too noisy to be compared.
+    """
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        checks = [('time', res['time'], base['time'], base['time'] >= min_time),
+                  ('peak_bytes', res['peak_bytes'], base['peak_bytes'], base['peak_bytes'] > 0),
+                  ('iterations', res['iterations'], base['iterations'], base['iterations'] is not None)]
+        for metric, new, old, comparable in checks:
+            if comparable and new is not None and new > (1 + threshold) * old:
+                regressions.append((key, metric, old, new))
+    return regressions
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'omp_num_threads': os.environ.get('OMP_NUM_THREADS'),
+            'package': path.dirname(path.abspath(RandomCorrMat.__file__))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RandomCorrMat benchmark suite')
+    parser.add_argument('--quick', action='store_true', help='two points per sweep')
+    parser.add_argument('--only', nargs='*', help='run the cases whose name contains one of these substrings')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown counted as a regression')
+    parser.add_argument('--min-time', type=float, default=5e-3,
+                        help='baseline times below this (s) are not compared')
+    parser.add_argument('--repeat-time', type=float, default=0.2, help='seconds spent timing each point')
+    args = parser.parse_args(argv)
+
+    results, exponents = run_suite(args.only, args.quick, args.repeat_time)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results, 'exponents': exponents}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold, args.min_time)
+        print('\ncompared with %s (threshold %d%%)' % (args.baseline, 100 * args.threshold))
+        for key, metric, old, new in regressions:
+            print('REGRESSION %-40s %-10s %12.6g -> %12.6g (%+.0f%%)' % (key, metric, old, new, 100. * (new / old - 1)))
+        if regressions:
+            return 1
+        print('no regression')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
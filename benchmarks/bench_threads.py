@@ -0,0 +1,126 @@
+# ---------------------------------------------------------------------------------
+# Split of the cpus between worker processes and BLAS threads on the current machine
+#
+#   python benchmarks/bench_threads.py                   # all cpus
+#   python benchmarks/bench_threads.py --cpus 8 --save threads.json
+#
+# Every workload is timed for each split processes x (cpus // processes) BLAS threads and for n_jobs='auto', and
+# the smallest size at which threaded BLAS beats one single-threaded worker per cpu is reported as the
+# blas_min_size to pass to set_thread_budget. Limiting the BLAS threads of the workers requires threadpoolctl.
+# ---------------------------------------------------------------------------------
+import argparse
+import json
+import sys
+import time
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from RandomCorrMat import ThreadBudget, ensemble_chunks, nearcorr_sequence, randCorrBlock, thread_budget
+from RandomCorrMat.Parallel import threadpool_limits, plan_execution
+
+
+def rolling_estimates(n, T):
+    rs = np.random.RandomState(0)
+    R = rs.randn(T + n, n)
+    As = np.array([np.corrcoef(R[t:t + n].T) for t in range(T)])
+    As += 0.05 * np.sign(As) * (1 - np.eye(n))
+    return As
+
+
+def workload_ensemble(n, count):
+    def run(n_jobs):
+        for _ in ensemble_chunks('randCorrOnion', count, chunk_size=max(1, count // 16), n_jobs=n_jobs, seed=0,
+                                 size=n):
+            pass
+    return run
+
+
+def workload_nearcorr_sequence(n, count):
+    As = rolling_estimates(n, count)
+    return lambda n_jobs: nearcorr_sequence(As, n_jobs=n_jobs, method='newton')
+
+
+def workload_randCorrBlock(n, count):
+    return lambda n_jobs: randCorrBlock([n] * count, structured=True, n_jobs=n_jobs, seed=0)
+
+
+# name: (workload, sizes, number of matrices for a size)
+WORKLOADS = {'ensemble_chunks': (workload_ensemble, (50, 200, 500, 1000), lambda n: max(16, 2 * 10 ** 8 // n ** 3)),
+             'nearcorr_sequence': (workload_nearcorr_sequence, (50, 100, 200, 400),
+                                   lambda n: max(8, 10 ** 6 // n ** 2)),
+             'randCorrBlock': (workload_randCorrBlock, (100, 500, 1000, 2000), lambda n: max(8, 4 * 10 ** 8 // n ** 3))}
+
+
+def splits(cpus):
+    """
+    Numbers of processes tried: the powers of 2 below cpus, and cpus.
+    """
+    res = [p for p in (2 ** k for k in range(cpus.bit_length())) if p < cpus]
+    return res + [cpus]
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def tune(cpus, names, repeat=1):
+    results = {}
+    with thread_budget(cpus=cpus) as budget:
+        for name in names:
+            workload, sizes, counts = WORKLOADS[name]
+            crossover = None
+            print('\n%s' % name)
+            print('%6s %6s %s %10s %12s' % ('n', 'count', ' '.join('%9s' % ('%dx%d' % (p, cpus // p))
+                                                                  for p in splits(cpus)), 'auto', 'best'))
+            for n in sizes:
+                count = counts(n)
+                run = workload(n, count)
+                times = {p: best_time(lambda: run(p), repeat) for p in splits(cpus)}
+                auto = best_time(lambda: run('auto'), repeat)
+                best = min(times, key=times.get)
+                if crossover is None and best < cpus:
+                    crossover = n
+                results['%s n=%d' % (name, n)] = {'count': count, 'times': {'%dx%d' % (p, cpus // p): t
+                                                                           for p, t in times.items()},
+                                                   'auto': auto, 'best_processes': best,
+                                                   'auto_plan': plan_execution(n, count)}
+                print('%6d %6d %s %10.4f %12s' % (n, count, ' '.join('%9.4f' % times[p] for p in splits(cpus)), auto,
+                                                  '%dx%d' % (best, cpus // best)))
+            results['%s blas_min_size' % name] = crossover
+            print('threaded BLAS pays off from n = %s (current blas_min_size %d)' % (crossover or '-',
+                                                                                    budget.blas_min_size))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tune the split between worker processes and BLAS threads')
+    parser.add_argument('--cpus', type=int, default=None, help='cpus of the budget, all by default')
+    parser.add_argument('--only', nargs='*', choices=sorted(WORKLOADS), help='workloads to run')
+    parser.add_argument('--repeat', type=int, default=1, help='timings per point, the best is kept')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    if threadpool_limits is None:
+        print('threadpoolctl is not installed: the BLAS threads of forked workers cannot be limited')
+    cpus = ThreadBudget(args.cpus).cpus
+    results = tune(cpus, args.only or sorted(WORKLOADS), args.repeat)
+    sizes = [v for k, v in results.items() if k.endswith('blas_min_size') and v is not None]
+    if sizes:
+        print('\nsuggested: set_thread_budget(cpus=%d, blas_min_size=%d)' % (cpus, min(sizes)))
+    else:
+        print('\nno size gained from threaded BLAS over one worker per cpu, keep blas_min_size above the sizes tried')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'cpus': cpus, 'results': results}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())